@@ -1,15 +1,21 @@
 from __future__ import annotations
 
 from tornado.web import Application, StaticFileHandler, RedirectHandler, RequestHandler
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes, cpu_count
 from rich.logging import RichHandler
 import importlib
 import asyncio
 import logging
-import contextlib
 import glob
-from typing import Any, Protocol, runtime_checkable, Literal, get_args
+import collections
+import datetime
+import asyncpg
+from typing import Any, Optional, Protocol, runtime_checkable, Literal, get_args
 
-from .utils import DB, TornadoUvloop, Tokens, RatelimitMapping
+from .utils import DB, connection_args, TornadoUvloop, Tokens, RatelimitMapping, DispatchEvent, SessionStore, create_bus, HeartbeatSupervisor, MemberIndex, GuildMembers, UserCache, PresenceStore, IdentifyQueue, MessageWriter, create_partitions
 from .extensions.gateway import Gateway
 
 @runtime_checkable
@@ -19,6 +25,13 @@ class ExtensionProtocol(Protocol):
         raise NotImplementedError
 
 destination_keys = Literal["guild", "channel"]
+stale_entities: dict[str, str] = {  # event -> the DB entity cache it makes out of date
+    "guild_update": "guilds",
+    "guild_delete": "guilds",
+    "channel_update": "channels",
+    "channel_delete": "channels",
+    "user_update": "users",
+}
 logger: logging.Logger = logging.getLogger()
 logger.addHandler(RichHandler(log_time_format="[%X]", show_path=False))
 
@@ -45,10 +58,24 @@ class App(Application):
 
         self.args = {"database": self.database, "tokens": self.tokens}
 
-        self.gateway_connections: dict[str, Gateway] = {}  # userid -> gateway
-        self.destinations: dict[destination_keys, dict[str, list[str]]] = {}  # type -> id -> userid[]
-        self.member_cache: dict[str, dict[str, dict[str, Any]]] = {}  # guildid -> userid -> user
-        self.user_cache: dict[str, dict[str, Any]] = {}  # userid -> user
+        self.gateway_connections: dict[int, list[Gateway]] = {}  # userid -> gateways, one per shard or client
+        self.destinations: dict[destination_keys, dict[int, list[int]]] = {}  # type -> id -> userid[]
+        self.member_cache: dict[int, GuildMembers] = {}  # guildid -> userid -> member
+        self.user_cache = UserCache()  # userid -> user, one record per user shared by all their guilds
+        self.member_index: dict[int, MemberIndex] = {}  # guildid -> username and nick search index
+        self.user_guilds: dict[int, set[int]] = {}  # userid -> guildids
+        self.guild_channels: dict[int, set[int]] = {}  # guildid -> channelids
+        self.loaded_guilds = collections.OrderedDict[int, None]()  # guildids with their state in memory, least recently used first
+        self.loading_guilds: dict[int, asyncio.Task[None]] = {}  # guildid -> the load its state is part of
+        self.pending_events: dict[int, list[tuple[str, Any]]] = {}  # guildid -> state changes that came in while it was loading
+        self.guild_state_budget: int = config["gateway"].get("guild_state_budget", 1000000)  # members kept loaded before inactive guilds get evicted
+        self.presences = PresenceStore(config["gateway"].get("presence_update_window", 0.5), self.publish_presence)
+        self.sessions = SessionStore.from_config(config["gateway"])
+        self.gateway_stats = collections.Counter[str]()  # dropped_events, slow_consumer_closes
+        self.identify_queue = IdentifyQueue.from_config(database, config["gateway"])
+        self.heartbeats = HeartbeatSupervisor(config["gateway"]["heartbeat_interval"] * 1.25 / 1000)
+        self.message_writer = MessageWriter.from_config(database, config.get("messages", {}))
+        self.bus = create_bus(config.get("bus", {}), self.on_bus_message, connection_args(config["database"]))
 
         self.global_ratelimit = RatelimitMapping.from_ratelimit(50, 1)  # todo: add increased global rate limit stuff
 
@@ -80,71 +107,364 @@ class App(Application):
     def run(cls, config: dict[str, Any], log_level: str):
         logger.setLevel(getattr(logging, log_level.upper()))
 
+        sockets = bind_sockets(config["app"]["port"], config["app"]["address"])
+
+        workers = config["app"].get("workers", 1)
+        if workers != 1 and config.get("bus", {}).get("backend", "local") == "local":
+            raise ValueError("More than one worker needs a bus backend other than local, events would never reach connections on the other workers")
+
+        if config["tokens"]["process_id"] + (workers or cpu_count()) > 32:
+            raise ValueError("tokens.process_id plus the number of workers cant be more than 32, snowflakes only have 5 bits for the process")
+
+        if workers != 1:
+            task_id = fork_processes(workers)  # has to happen before the loop or pool are created
+            config["tokens"]["process_id"] += task_id  # snowflakes have to stay unique between workers
+
         TornadoUvloop.current().make_current()
         loop = asyncio.get_event_loop()
 
-        db = loop.run_until_complete(DB.from_args(config["database"]))
+        loop.run_until_complete(cls.create_message_partitions(config))  # before the pool exists, see create_message_partitions
+        db = loop.run_until_complete(DB.from_args(config["database"], config.get("cache")))
         server = cls(db, config)
 
         loop.run_until_complete(server.startup())
 
-        server.listen(config["app"]["port"], config["app"]["address"])
+        HTTPServer(server).add_sockets(sockets)
 
         logging.info(f"running at http://{config['app']['address']}:{config['app']['port']}")
         TornadoUvloop.current().start()
 
-    def dispatch_event(self, event_name: str, payload: Any, *, index: str, index_type: destination_keys):
+    def dispatch_event(self, event_name: str, payload: Any, *, index: int, index_type: destination_keys, guild_id: Optional[int] = None):
+        if index_type == "guild":
+            guild_id = index
+
+        self.bus.publish({"type": "dispatch", "event": event_name, "payload": payload, "index": index, "index_type": index_type, "guild_id": guild_id})
+
+    def send_event(self, event_name: str, user_id: int, payload: Any, *, guild_id: Optional[int] = None):
+        self.bus.publish({"type": "send", "event": event_name, "payload": payload, "user_id": user_id, "guild_id": guild_id})
+
+    def on_bus_message(self, message: dict[str, Any]):
+        # every worker gets every event, each one only delivers to the connections it holds itself
+        if message["type"] == "send":
+            return self.deliver_event(message["user_id"], DispatchEvent(message["event"], message["payload"], message["guild_id"]), message["guild_id"])
+
+        event_name, payload, index, index_type, guild_id = message["event"], message["payload"], message["index"], message["index_type"], message["guild_id"]
+
+        self.apply_event(event_name, payload, guild_id)
+
         users = self.destinations[index_type].get(index)
         logging.debug(users)
 
         if users is None:
             logging.debug("Ignoring event %s with index %s:%s", event_name, index, index_type)
-            return
+        else:
+            logger.debug("Dispatching event %s with index %s:%s", event_name, index, index_type)
+            event = DispatchEvent(event_name, payload, guild_id)  # shared between every connection so the payload is only serialized once
 
-        logger.debug("Dispatching event %s with index %s:%s", event_name, index, index_type)
-        for user_id in users:
-            self.send_event(event_name, user_id, payload)
+            for user_id in users:
+                self.deliver_event(user_id, event, guild_id)
 
-    def send_event(self, event_name: str, user_id: str, payload: Any):
-        with contextlib.suppress(KeyError):  # they are not online - ignore them
-            self.gateway_connections[user_id].push_event(event_name, payload)
+        self.forget_event(event_name, payload, guild_id)
 
+    def deliver_event(self, user_id: int, event: DispatchEvent, guild_id: Optional[int] = None):
+        # only connections with the right intents on the shard that owns the guild get it, otherwise they are not online - ignore them
+        for connection in self.gateway_connections.get(user_id, ()):
+            if connection.session.accepts(event, guild_id):  # type: ignore
+                connection.push_dispatch(event)
 
-    async def fill_destinations(self):
-        async with self.database.accqire() as conn:
-            members = await conn.fetch("select user_id, guild_id from guild_members")
-            channels = await conn.fetch("select id, guild_id from guild_channels")
+        for session in self.sessions.detached.get(user_id, ()):
+            if session.accepts(event, guild_id):
+                session.record(event)  # they are reconnecting - keep it so it can be replayed when they resume
 
-        for member in members:
-            self.destinations["guild"].setdefault(member["guild_id"], []).append(member["user_id"])
+    def cache_member(self, guild_id: int, member: dict[str, Any]):
+        user = member["user"]
 
-        for channel in channels:
-            self.destinations["channel"][channel["id"]] = self.destinations["guild"][channel["guild_id"]]  # ill switch this to permissions when i implement them, until then its the same as guilds
+        record = self.user_cache.set(user)
+        self.member_cache.setdefault(guild_id, GuildMembers()).add(record, member.get("nick"), member["mute"], member["deaf"], member["joined_at"], member.get("roles", ()))
 
-    async def fill_member_cache(self):
-        async with self.database.accqire() as conn:
-            rows = await conn.fetch("select user_id, guild_members.guild_id, joined_at, deaf, mute, nick, username, discriminator, avatar from guild_members inner join users on guild_members.user_id = users.id")
+        self.member_index.setdefault(guild_id, MemberIndex()).add(user["id"], (user["username"], member.get("nick")))
+        self.user_guilds.setdefault(user["id"], set()).add(guild_id)
+
+    def publish_presence(self, user_id: int, presence: dict[str, Any]):
+        # one presence_update per guild, dispatch_event only encodes it once for everyone in there
+        for guild_id in self.user_guilds.get(user_id, ()):
+            self.dispatch_event("presence_update", {"user": {"id": user_id}, "guild_id": guild_id} | presence, index=guild_id, index_type="guild")
 
-        for row in rows:
-            user = {
-                "username": row["username"],
-                "discriminator": row["discriminator"],
-                "id": row["user_id"],
-                "avatar": row["avatar"]
-            }
+    # the local state is kept up to date from the events instead of in the handlers so every worker stays in sync
 
-            member = {
-                "id": row["user_id"],
-                "nick": row["nick"],
-                "mute": row["mute"],
-                "deaf": row["deaf"],
-                "joined_at": row["joined_at"],
-                "roles": []
-            }
+    def apply_event(self, event_name: str, payload: Any, guild_id: Optional[int]):
+        if (entity := stale_entities.get(event_name)) is not None:
+            getattr(self.database, entity).invalidate(payload["id"])
 
-            self.user_cache[row["user_id"]] = user
-            self.member_cache.setdefault(row["guild_id"], {})[user["id"]] = member
+        if event_name == "presence_update":
+            return self.presences.set(payload["user"]["id"], {"status": payload["status"], "activities": payload["activities"]})
+
+        if event_name == "guild_member_update":
+            self.database.users.invalidate(payload["user"]["id"])
+
+        if event_name == "guild_member_add" and guild_id is not None:
+            # payload["user"] is the member who joined, they might be connected here and need the guild straight away
+            self.add_session_guild(payload["user"]["id"], guild_id)
+
+        if guild_id in self.loading_guilds:
+            return self.pending_events[guild_id].append((event_name, payload))  # type: ignore  # replayed once the load is done
+
+        if guild_id not in self.loaded_guilds:
+            if event_name == "guild_member_add" and guild_id is not None and self.is_local(payload["user"]["id"]):
+                # someone here just joined it so its state is needed now, the join is already committed so the load picks them up
+                asyncio.create_task(self.load_guilds([guild_id]))
+                return
+            elif event_name != "guild_create":
+                return  # nobody here is in it, the state gets loaded from the database once someone is
+
+        if event_name == "guild_create":
+            for member in payload["members"]:
+                self.cache_member(payload["id"], member)
+
+            self.destinations["guild"][payload["id"]] = [member["user"]["id"] for member in payload["members"]]
+            self.loaded_guilds[payload["id"]] = None
+            self.add_session_guild(payload["owner_id"], payload["id"])  # they just made it
+
+        elif event_name == "guild_member_add":
+            self.cache_member(guild_id, payload)  # type: ignore
+
+            users = self.destinations["guild"].setdefault(guild_id, [])  # type: ignore
+            if payload["user"]["id"] not in users:
+                users.append(payload["user"]["id"])
+
+        elif event_name == "guild_member_update":
+            member = self.member_cache.get(guild_id, {}).get(payload["user"]["id"])  # type: ignore
+            if member is not None:
+                self.cache_member(guild_id, member | payload)  # type: ignore
+
+        elif event_name == "channel_create":
+            self.destinations["channel"][payload["id"]] = self.destinations["guild"].setdefault(guild_id, [])  # type: ignore
+            self.guild_channels.setdefault(guild_id, set()).add(payload["id"])  # type: ignore
+
+    def forget_event(self, event_name: str, payload: Any, guild_id: Optional[int]):
+        if guild_id in self.loading_guilds or guild_id not in self.loaded_guilds:
+            return  # queued or ignored by apply_event already
+
+        if event_name == "guild_delete":
+            self.unload_guild(payload["id"])
+
+        elif event_name == "guild_member_remove":
+            user_id = payload["user"]["id"]
+
+            self.member_cache.get(guild_id, {}).pop(user_id, None)  # type: ignore
+            self.user_guilds.get(user_id, set()).discard(guild_id)  # type: ignore
+            if (index := self.member_index.get(guild_id)) is not None:  # type: ignore
+                index.remove(user_id)
+            if user_id in (users := self.destinations["guild"].get(guild_id, [])):  # type: ignore
+                users.remove(user_id)
+
+        elif event_name == "channel_delete":
+            self.destinations["channel"].pop(payload["id"], None)
+            self.guild_channels.get(guild_id, set()).discard(payload["id"])  # type: ignore
+
+    # guild state is only loaded once a member of the guild connects to this worker,
+    # and guilds nobody here is connected to anymore get dropped again when there are more members loaded than the budget
+
+    def is_local(self, user_id: int) -> bool:
+        return user_id in self.gateway_connections or user_id in self.sessions.detached
+
+    async def load_guilds(self, guild_ids: list[int]):
+        missing: list[int] = []
+        waiting: set[asyncio.Task[None]] = set()
+
+        for guild_id in guild_ids:
+            if guild_id in self.loaded_guilds:
+                self.loaded_guilds.move_to_end(guild_id)
+            elif (task := self.loading_guilds.get(guild_id)) is not None:
+                waiting.add(task)
+            else:
+                missing.append(guild_id)
+
+        if missing:
+            task = asyncio.create_task(self.load_missing_guilds(missing))
+            for guild_id in missing:
+                self.loading_guilds[guild_id] = task
+                self.pending_events[guild_id] = []
+
+            waiting.add(task)
+
+        if waiting:
+            await asyncio.shield(asyncio.gather(*waiting))  # one connection going away mid identify doesnt cancel a load others are waiting on
+
+    async def load_missing_guilds(self, guild_ids: list[int]):
+        try:
+            await self.fetch_guild_state(guild_ids)
+        except Exception:
+            logger.exception("Could not load the state of %s guilds", len(guild_ids))  # they get another go when the next member connects
+        finally:
+            for guild_id in guild_ids:
+                del self.loading_guilds[guild_id]
+                pending = self.pending_events.pop(guild_id)
+
+                if guild_id in self.loaded_guilds:
+                    for event_name, payload in pending:
+                        self.apply_event(event_name, payload, guild_id)
+                        self.forget_event(event_name, payload, guild_id)
+
+        self.evict_guilds(keep=guild_ids)
+
+    async def fetch_guild_state(self, guild_ids: list[int]):
+        batch_size = self.config["gateway"].get("guild_load_batch_size", 1000)
+        names: dict[int, list[tuple[int, tuple[str, Optional[str]]]]] = {guild_id: [] for guild_id in guild_ids}  # guildid -> (userid, names) to bulk load the search indexes with
+        members: dict[int, GuildMembers] = {guild_id: GuildMembers() for guild_id in guild_ids}
+        channels: dict[int, set[int]] = {guild_id: set() for guild_id in guild_ids}
+
+        async with self.database.accqire() as conn:  # cursors only live inside a transaction
+            for row in await self.database.queries.fetch(conn, "get_guilds_channel_ids", guild_ids):
+                channels[row["guild_id"]].add(row["id"])
+
+            # streamed in batches so a huge guild never has to sit in memory as records and dicts at the same time
+            async for row in self.database.queries.cursor(conn, "get_guilds_member_state", guild_ids, prefetch=batch_size):
+                user = self.user_cache.add(row["user_id"], row["username"], row["discriminator"], row["avatar"])
+                members[row["guild_id"]].add(user, row["nick"], row["mute"], row["deaf"], row["joined_at"])
+                names[row["guild_id"]].append((row["user_id"], (row["username"], row["nick"])))
+
+        for guild_id in guild_ids:
+            self.member_cache[guild_id] = members[guild_id]
+            self.destinations["guild"][guild_id] = users = list(members[guild_id])
+            self.guild_channels[guild_id] = channels[guild_id]
+
+            for channel_id in channels[guild_id]:
+                self.destinations["channel"][channel_id] = users  # ill switch this to permissions when i implement them, until then its the same as guilds
+
+            for user_id in users:
+                self.user_guilds.setdefault(user_id, set()).add(guild_id)
+
+            index = self.member_index[guild_id] = MemberIndex()
+            index.extend(names[guild_id])
+            self.loaded_guilds[guild_id] = None
+
+    def unload_guild(self, guild_id: int):
+        self.loaded_guilds.pop(guild_id, None)
+        self.destinations["guild"].pop(guild_id, None)
+        self.member_index.pop(guild_id, None)
+
+        for channel_id in self.guild_channels.pop(guild_id, ()):
+            self.destinations["channel"].pop(channel_id, None)
+
+        for user_id in self.member_cache.pop(guild_id, ()):
+            guilds = self.user_guilds.get(user_id)
+            if guilds is not None:
+                guilds.discard(guild_id)
+                if not guilds:
+                    del self.user_guilds[user_id]
+                    self.user_cache.pop(user_id, None)
+
+    def add_session_guild(self, user_id: int, guild_id: int):
+        # guilds joined after identify, so their events reach the connection and eviction knows they are in use
+        sessions = [connection.session for connection in self.gateway_connections.get(user_id, ()) if connection.session is not None]
+        sessions.extend(self.sessions.detached.get(user_id, ()))
+
+        for session in sessions:
+            if session.owns(guild_id) and guild_id not in session.guild_ids:
+                session.guild_ids.append(guild_id)  # the same list as the connections guild_ids
+
+    def evict_guilds(self, keep: Optional[list[int]] = None):
+        loaded = sum(len(self.member_cache.get(guild_id, ())) for guild_id in self.loaded_guilds)
+        if loaded <= self.guild_state_budget:
+            return
+
+        active = set(keep or ())  # guilds someone here is connected to or could still resume into
+        for connections in self.gateway_connections.values():
+            for connection in connections:
+                active.update(connection.guild_ids)
+        for sessions in self.sessions.detached.values():
+            for session in sessions:
+                active.update(session.guild_ids)
+
+        evicted = 0
+        for guild_id in list(self.loaded_guilds):  # least recently used first
+            if loaded <= self.guild_state_budget:
+                break
+            if guild_id in active:
+                continue
+
+            loaded -= len(self.member_cache.get(guild_id, ()))
+            self.unload_guild(guild_id)
+            evicted += 1
+
+        if evicted:
+            logger.info("Evicted %s inactive guilds, %s members still loaded", evicted, loaded)
+
+    async def get_member(self, guild_id: int, user_id: int) -> Optional[tuple[dict[str, Any], dict[str, Any]]]:
+        # (user, member) from the cache if the guild is loaded here, otherwise from the database
+        if (member := self.member_cache.get(guild_id, {}).get(user_id)) is not None:
+            return self.user_cache[user_id], member
+
+        members = await self.database.get_members(guild_id, user_ids=[user_id])
+        if not members:
+            return None
+
+        member = members[0]
+        user = member["user"]
+
+        return user, {
+            "id": user["id"],
+            "nick": member["nick"],
+            "mute": member["mute"],
+            "deaf": member["deaf"],
+            "joined_at": member["joined_at"],
+            "roles": member["roles"]
+        }
 
     async def startup(self):
-        await self.fill_destinations()
-        await self.fill_member_cache()
+        await self.bus.start()
+        self.heartbeats.start()
+        PeriodicCallback(self.log_database_stats, 60000).start()
+        PeriodicCallback(self.schedule_message_partitions, 86400000).start()
+
+    @staticmethod
+    async def create_message_partitions(config: dict[str, Any]):
+        # always keep a couple of months ahead so nothing ends up in messages_default.
+        # creating a partition takes a strong lock on messages, which has to wait for every open transaction on it while every query after it
+        # waits too. it gets its own connection with a lock_timeout so it gives up instead of stalling the pool
+        try:
+            conn: asyncpg.Connection = await asyncpg.connect(**connection_args(config["database"]), server_settings={"lock_timeout": "5000"})
+        except (OSError, asyncpg.PostgresError) as e:
+            return logger.warning("Could not connect to create message partitions: %s", e)
+
+        try:
+            created = await create_partitions(conn, config["tokens"]["epoch"], datetime.datetime.now(datetime.timezone.utc), 3)
+        except asyncpg.PostgresError as e:
+            return logger.warning("Could not create message partitions: %s", e)
+        finally:
+            await conn.close()
+
+        if created:
+            logger.info("Created message partitions %s", ", ".join(created))
+
+    def schedule_message_partitions(self):
+        # PeriodicCallback only takes plain functions, so the coroutine runs as its own task and anything it didnt handle gets logged
+        def done(task: asyncio.Task[None]):
+            if not task.cancelled() and (error := task.exception()) is not None:
+                logger.error("Creating message partitions failed", exc_info=error)
+
+        asyncio.create_task(self.create_message_partitions(self.config)).add_done_callback(done)
+
+    def log_database_stats(self):
+        pool = self.database.get_pool_stats()
+        logger.debug("Pool: %s connections in use (min %s, max %s), %s waiting, %s acquires waited %.2fms avg %.1fms max, %s transactions took %.2fms avg %.1fms max",
+                     pool["in_use"], pool["min_size"], pool["max_size"], pool["waiting"], pool["acquires"], pool["acquire_wait_avg"] * 1000, pool["acquire_wait_max"] * 1000,
+                     pool["transactions"], pool["transaction_avg"] * 1000, pool["transaction_max"] * 1000)
+        if pool["replica"]:
+            logger.debug("Replica pool: %s/%s connections in use", pool["replica_in_use"], pool["max_size"])
+
+        for name, stats in self.database.queries.report():
+            logger.debug("Query %s: %s calls, %.1fms total, %.2fms avg, %.2fms max", name, stats.calls, stats.total * 1000, stats.total / stats.calls * 1000, stats.max * 1000)
+
+        for name in ("users", "channels", "guilds"):
+            cache = getattr(self.database, name)
+            logger.debug("Cache %s: %s entries, %s hits, %s misses (%.1f%%), %s evictions", name, len(cache), cache.hits, cache.misses, cache.get_hit_ratio() * 100, cache.evictions)
+
+        gateway = self.gateway_stats
+        logger.debug("Gateway: %s connections, %s events dropped, %s slow consumers closed, %s heartbeats timed out",
+                     sum(map(len, self.gateway_connections.values())), gateway["dropped_events"], gateway["slow_consumer_closes"], self.heartbeats.expired)
+
+        writer = self.message_writer
+        if writer.batches:
+            logger.debug("Messages: %s written in %s batches (%.1f per batch)", writer.written, writer.batches, writer.written / writer.batches)
@@ -9,7 +9,7 @@ class Invites(RequestHandler):
         "unique": {"type": "boolean", "default": False, "required": False},
         "temporary": {"type": "boolean", "default": False, "required": False},
     })
-    async def post(self, channel_id: str):
+    async def post(self, channel_id: int):
         code = self.tokens.generate_invite_code()  # the likelyhood of 2 having the same code is very low so im just going to pretend it wont happen
         created_at = datetime.datetime.utcnow()
 
@@ -26,8 +26,7 @@ class Invites(RequestHandler):
 
             guild = await self.database.get_guild(guild_id, partial=True)
 
-            await conn.execute("insert into guild_invites(code, channel_id, max_uses, guild_id, expires_at, inviter_id, max_age, temporary, created_at) values($1, $2, $3, $4, $5, $6, $7, $8, $9)",
-                               code, channel_id, self.body["max_uses"], guild_id, expires_at, self.user_id, max_age, self.body["temporary"], created_at.isoformat())
+            await self.database.queries.execute(conn, "create_invite", code, channel_id, self.body["max_uses"], guild_id, expires_at, self.user_id, max_age, self.body["temporary"], created_at.isoformat())
 
             channel = await self.database.get_channel(channel_id, conn=conn, partial=True)
             inviter = await self.database.get_user(self.user_id)
@@ -45,7 +44,7 @@ class Invites(RequestHandler):
         payload["guild_id"] = payload.pop("guild")["id"]
         payload["channel_id"] = payload.pop("channel")["id"]
 
-        self.application.dispatch_event("invite_create", payload, index=channel_id, index_type="channel")
+        self.application.dispatch_event("invite_create", payload, index=channel_id, index_type="channel", guild_id=guild_id)
 
 def setup(app):
-    return [(f"/api/v{app.version}/channels/(.+)/invites", Invites, app.args)]
+    return [(f"/api/v{app.version}/channels/(?P<channel_id>[0-9]+)/invites", Invites, app.args)]
@@ -1,5 +1,5 @@
 
-from app.utils import spec, RequestHandler, embed_spec, allowed_mentions_spec, JsonErrors, MessageTypes
+from app.utils import spec, RequestHandler, embed_spec, allowed_mentions_spec, JsonErrors, MessageTypes, CustomError
 from asyncpg.exceptions import ForeignKeyViolationError
 
 class Messages(RequestHandler):
@@ -9,7 +9,7 @@ class Messages(RequestHandler):
         "embed": {"type": "dict", "schema": embed_spec, "required": False},
         "allowed_mentions": {"type": "dict", "schema": allowed_mentions_spec, "required": False, "default": None, "nullable": True}
     }, require_all=False)
-    async def post(self, channel_id: str):
+    async def post(self, channel_id: int):
         content = self.body["content"]
         embed_passed = "embed" in self.body
         tts = self.body["tts"]
@@ -25,13 +25,18 @@ class Messages(RequestHandler):
         
         id = self.tokens.create_id()
 
-        async with self.database.accqire() as conn:
-            try:
-                await conn.execute("insert into messages(id, channel_id, content, tts, embeds, allowed_mentions) values ($1, $2, $3, $4, $5, $6)", id, channel_id, content, tts, embeds, allowed_mentions)
-            except ForeignKeyViolationError:
-                return self.error(JsonErrors.unknown_channel, status_code=404)
+        try:
+            guild_id = await self.database.get_guild_id_from_channel_id(channel_id)
+        except CustomError:
+            return self.error(JsonErrors.unknown_channel, status_code=404)
 
-            guild_id = await conn.fetchval("select guild_id from guild_channels where id=$1", channel_id)
+        if (found := await self.application.get_member(guild_id, self.user_id)) is None:
+            return self.error(JsonErrors.missing_access, 403)
+
+        try:
+            await self.application.message_writer.insert(id, channel_id, content, tts, embeds, allowed_mentions)
+        except ForeignKeyViolationError:
+            return self.error(JsonErrors.unknown_channel, status_code=404)
 
         message = {
             "id": id,
@@ -52,20 +57,23 @@ class Messages(RequestHandler):
 
         self.finish(message)
 
-        message["author"] = self.application.user_cache[self.user_id]
-        message["member"] = self.application.member_cache[guild_id][self.user_id]  # type: ignore
+        message["author"], message["member"] = found
 
-        print(message)
+        self.application.dispatch_event("message_create", message, index=channel_id, index_type="channel", guild_id=guild_id)
 
-        self.application.dispatch_event("message_create", message, index=channel_id, index_type="channel")
+    async def get(self, channel_id: int):
+        try:
+            limit = max(1, min(int(self.get_query_argument("limit", 50)), 100))
+            anchors = {key: int(value) for key in ("before", "after", "around") if (value := self.get_query_argument(key)) is not None}
+        except ValueError:
+            return self.error(JsonErrors.invalid_form, error="Invalid snowflake or limit.")
 
-    async def get(self, channel_id: str):
-        limit = self.get_query_argument("limit", "100")
+        if len(anchors) > 1:
+            return self.error(JsonErrors.invalid_form, error="Only one of before, after and around can be used.")
+
+        messages = await self.database.get_messages(channel_id, limit=limit, before=anchors.get("before"), after=anchors.get("after"), around=anchors.get("around"))
 
-        async with self.database.accqire() as conn:
-            messages = await conn.fetch("select * from messages where channel_id=$1 order by id desc limit $2", channel_id, limit)
-        
         self.finish(messages)
 
 def setup(app):
-    return [(f"/api/v{app.version}/channels/(.+)/messages", Messages, app.args)]
+    return [(f"/api/v{app.version}/channels/(?P<channel_id>[0-9]+)/messages", Messages, app.args)]
@@ -1,15 +1,15 @@
-from app.utils import GatewayOps, GatewayErrors, WebSocketHandler, DB, Tokens, CustomError, Spec, Validator
+from app.utils import GatewayOps, GatewayErrors, WebSocketHandler, DB, Tokens, CustomError, Spec, Validator, DispatchEvent, Encoding, encodings, Session, get_shard_id, GatewayIntents, snowflake
 
-from typing import Optional, Any
-import datetime
-import ujson
+from typing import Optional, Any, Union
+import time
+import zlib
 import asyncio
 import logging
 
 generic_spec: Spec = {
     "op": {
         "type": "number",
-        "allowed": [0,1,2,3,4,5,6,7,9,10,11,12]
+        "allowed": [0,1,2,3,4,5,6,7,8,9,10,11,12]
     },
     "d": {
         "allow_unknown": True,
@@ -18,9 +18,20 @@ generic_spec: Spec = {
 }
 generic: Validator = Validator(generic_spec, allow_unknown=True)
 
+presence_spec: Spec = {
+    "since": {"type": "integer", "nullable": True, "required": False},
+    "activities": {"type": "list", "required": False, "default": [], "schema": {"type": "dict", "allow_unknown": True}},
+    "status": {"type": "string", "required": True, "allowed": ["online", "dnd", "idle", "invisible", "offline"]},
+    "afk": {"type": "boolean", "required": False}
+}
+
+presence: Validator = Validator(presence_spec, allow_unknown=True)
+
 identify_spec: Spec = {
     "token": {"type": "string"},
-    "intents": {"type": "number"},
+    "intents": {"type": "integer", "min": 0},
+    "shard": {"type": "list", "required": False, "items": [{"type": "integer", "min": 0}, {"type": "integer", "min": 1}]},
+    "presence": {"type": "dict", "required": False, "schema": presence_spec},
     "properties": {
         "type": "dict",
         "allow_unknown": True,
@@ -34,12 +45,20 @@ identify_spec: Spec = {
 
 identify: Validator = Validator(identify_spec, allow_unknown=True)
 
+resume_spec: Spec = {
+    "token": {"type": "string"},
+    "session_id": {"type": "string"},
+    "seq": {"type": "integer", "min": 0, "nullable": True}
+}
+
+resume: Validator = Validator(resume_spec, allow_unknown=True)
+
 member_chunk_spec: Spec = {
-    "guild_id": {"type": "string"},
+    "guild_id": {"type": ["string", "integer"]},  # ids are strings in json and ints in etf
     "query": {"type": "string", "required": False, "excludes": "user_ids"},
-    "limit": {"type": "string", "dependencies": "query"},
+    "limit": {"type": "integer", "required": False, "min": 0, "default": 0},
     "presences": {"type": "boolean", "required": False, "default": False},
-    # "user_ids": {"type": "list", "schema": {"type": "string"}},
+    "user_ids": {"type": ["string", "integer", "list"], "required": False, "excludes": "query", "schema": {"type": ["string", "integer"]}},
     "nonce": {"type": "string", "required": False}
 }
 
@@ -47,17 +66,26 @@ member_chunk: Validator = Validator(member_chunk_spec, allow_unknown=True)
 
 class Gateway(WebSocketHandler):
     def initialize(self, database: DB, tokens: Tokens) -> None:
-        self.heartbeat_event = asyncio.Event()
-        self.last_heartbeat_ack = datetime.datetime.utcnow()
+        self.heartbeat_deadline = 0.0  # managed by the app's heartbeat supervisor
         self.identitied = False
-        self.user_id = None
+        self.user_id: Optional[int] = None
         self.s = 0
         self.guild_ids = []  # list of guild ids the user is in
-        self.queue = asyncio.Queue[tuple[str, Any]]()
+        self.session: Optional[Session] = None
+        self.queue = asyncio.Queue[tuple[int, DispatchEvent]](self.application.config["gateway"].get("send_queue_size", 10000))
+        self.high_water = self.application.config["gateway"].get("send_queue_high_water", 1000)
+        self.slow_consumer_timeout = self.application.config["gateway"].get("slow_consumer_timeout", 30)
+        self.high_water_since: Optional[float] = None  # when the queue went over the high water mark
+        self.dispatcher_task: Optional[asyncio.Task[None]] = None
+        self.identify_task: Optional[asyncio.Task[None]] = None
         self.heartbeat_interval = self.application.config["gateway"]["heartbeat_interval"]
         self.gateway_version = self.application.config["gateway"]["version"]
-        self.started_at = datetime.datetime.utcnow()
+        self.started_at = time.monotonic()
         self.sleep_interval = (self.heartbeat_interval * 1.25) / 1000
+        self.encoding: Encoding = encodings["json"]
+        self.compressor: Optional[zlib._Compress] = None
+        self.bytes_raw = 0  # what we would have sent without compression
+        self.bytes_sent = 0
         super().initialize(database, tokens)
 
     async def open(self):
@@ -66,14 +94,28 @@ class Gateway(WebSocketHandler):
             return self.close(GatewayErrors.invalid_version, "Requested gateway version is no longer supported or invalid.")
 
         encoding = self.get_query_argument("encoding", default="json")
-        if encoding != "json":
-            return self.close(GatewayErrors.unknown, "Invalid encoding, only json is supported.")
+        if encoding not in encodings:
+            return self.close(GatewayErrors.unknown, f"Invalid encoding, supported encodings are {', '.join(encodings)}.")
+
+        self.encoding = encodings[encoding]
+
+        compress = self.get_query_argument("compress", default=None)
+        if compress is not None:
+            if compress != "zlib-stream":
+                return self.close(GatewayErrors.unknown, "Invalid compression, only zlib-stream is supported.")
+
+            if not self.application.config["gateway"].get("compression", True):
+                return self.close(GatewayErrors.unknown, "Compression is disabled.")
 
+            # one compressor for the lifetime of the connection so the client can keep a single inflate context
+            self.compressor = zlib.compressobj(self.application.config["gateway"].get("compression_level", 6))
+
+        self.application.heartbeats.add(self)
         await self.send_message(GatewayOps.hello, {"heartbeat_interval": self.heartbeat_interval})
 
     async def on_message(self, message):
         try:
-            data = ujson.loads(message)
+            data = self.encoding.loads(message)
         except:
             return self.close(GatewayErrors.decode_error, "Error decoding message.")
         
@@ -87,10 +129,10 @@ class Gateway(WebSocketHandler):
 
         payload = data["d"]
 
-        if data["op"] != GatewayOps.identify and self.identitied is False and (self.started_at + datetime.timedelta(seconds=self.sleep_interval) < datetime.datetime.utcnow()):
+        if data["op"] not in (GatewayOps.identify, GatewayOps.resume) and self.identitied is False and (self.started_at + self.sleep_interval < time.monotonic()):
             return self.close(GatewayErrors.not_authed, "No identify message sent")
 
-        elif data["op"] == GatewayOps.identify and self.identitied is not False:
+        elif data["op"] in (GatewayOps.identify, GatewayOps.resume) and self.identitied is not False:
             return self.close(GatewayErrors.already_authed, "Identify already sent")
 
         if data["op"] == GatewayOps.identify:
@@ -105,38 +147,68 @@ class Gateway(WebSocketHandler):
             except CustomError:
                 return self.close(GatewayErrors.auth_failed, "Invalid token")
 
-            self.intents = payload["intents"]
+            intents = payload.get("intents", GatewayIntents.all())  # user accounts dont send intents and get everything
+            if intents & ~GatewayIntents.all():
+                return self.close(GatewayErrors.invalid_intents, "Invalid intents")
+
+            shard_id, num_shards = payload.get("shard", [0, 1])
+            if shard_id >= num_shards:
+                return self.close(GatewayErrors.invalid_shard, "Invalid shard")
+
+            self.identitied = True  # stops a second identify getting in while this one is waiting in the queue
+            self.identify_task = asyncio.create_task(self.identify(payload, intents, shard_id, num_shards))
+
+        elif data["op"] == GatewayOps.resume:
+            status: bool = resume.validate(payload)
+            if not status:
+                return self.close(GatewayErrors.decode_error, "Invalid payload")
+
+            try:
+                user_id = self.tokens.validate_token(payload["token"])
+            except CustomError:
+                return self.close(GatewayErrors.auth_failed, "Invalid token")
+
+            session = self.application.sessions.get(payload["session_id"])
+            seq = payload["seq"] or 0
+
+            if session is None or session.user_id != user_id or (missed := session.replay(seq)) is None:
+                return await self.send_message(GatewayOps.invalid_session, False)
+
+            for old in list(self.application.gateway_connections.get(user_id, [])):
+                if old.session is session:
+                    old.remove_connection()  # the old connection hasnt noticed its dead yet, take over from it
+                    old.close()
+
+            self.application.sessions.attach(session)
+
+            self.user_id = user_id
+            self.session = session
+            self.intents = session.intents
+            self.guild_ids = session.guild_ids
+            self.s = seq
             self.identitied = True
-            self.application.gateway_connections[self.user_id] = self
+            self.application.gateway_connections.setdefault(user_id, []).append(self)
 
-            asyncio.create_task(self.dispatcher())
-            asyncio.create_task(self.heartbeat_task())
+            for s, event in missed:
+                self.enqueue(s, event)
 
-            async with self.database.accqire() as conn:
-                rows = await conn.fetch("select guild_id from guild_members where user_id=$1", self.user_id)
-                guild_ids = [row["guild_id"] for row in rows]
-            
+            self.push_event("resumed", {})
+            self.update_presence(session.presence)
 
-                ready = {
-                    "v": self.gateway_version,
-                    "user": await self.database.get_user(self.user_id),
-                    "guilds": [{"id": id, "unavailable": True} for id in guild_ids],
-                    "session_id": 0,  # will do this eventually
-                    "application": {
-                        "id": self.user_id,
-                        "flags": 0
-                    }
-                }
+            self.dispatcher_task = asyncio.create_task(self.dispatcher())
 
-                self.push_event("ready", ready)
+        elif data["op"] == GatewayOps.presence_update:
+            if self.user_id is None:
+                return self.close(GatewayErrors.not_authed, "No identify message sent")  # still in the grace period, theres nobody to set a presence for
 
-                for guild_id in guild_ids:
-                    guild = await self.database.get_guild(guild_id, conn=conn, extra_info=True)
-                    self.push_event("guild_create", guild)
+            status: bool = presence.validate(payload)
+            if not status:
+                return self.close(GatewayErrors.decode_error, "Invalid payload")
+
+            self.update_presence(payload)
 
         elif data["op"] == GatewayOps.heartbeat:
-            self.last_heartbeat_ack = datetime.datetime.utcnow()
-            self.heartbeat_event.set()
+            self.application.heartbeats.touch(self)
             await self.send_message(GatewayOps.heartbeat_ack, self.s)
 
         elif data["op"] == GatewayOps.request_guild_members:
@@ -144,55 +216,197 @@ class Gateway(WebSocketHandler):
             if not status:
                 return self.close(GatewayErrors.decode_error, "Invalid message shape")
 
-            if (guild_id := payload["guild_id"]) not in self.guild_ids:
+            if (guild_id := snowflake(payload["guild_id"])) not in self.guild_ids:
                 return
 
-            members = list(self.application.member_cache[guild_id].values())
-            chunks = [members[i:i+1000] for i in range(0, len(members), 1000)]
+            member_cache = self.application.member_cache.get(guild_id, {})
+            limit = payload.get("limit") or 0
+            not_found = []
+
+            if (user_ids := payload.get("user_ids")) is not None:
+                if not isinstance(user_ids, list):
+                    user_ids = [user_ids]
+
+                members = []
+                for user_id in user_ids[:limit or None]:
+                    if (member := member_cache.get(snowflake(user_id))) is not None:
+                        members.append(member)
+                    else:
+                        not_found.append(user_id)
+
+            elif (query := payload.get("query")):
+                index = self.application.member_index.get(guild_id)
+                user_ids = index.search(query, limit or 100) if index is not None else []
+                members = [member_cache[user_id] for user_id in user_ids]
+
+            else:
+                members = list(member_cache.values())
+                if limit:
+                    members = members[:limit]
+
+            chunks = [members[i:i+1000] for i in range(0, len(members), 1000)] or [[]]
             chunk_count = len(chunks)
 
             for i, chunk in enumerate(chunks):
-                chunk = [member  | {"user": self.application.user_cache[member["id"]]} for member in chunk]
+                chunk: list[dict[str, Any]] = [member  | {"user": self.application.user_cache[member["id"]]} for member in chunk]
 
                 chunk_payload = {
                     "guild_id": guild_id,
                     "members": chunk,
                     "chunk_index": i,
                     "chunk_count": chunk_count,
-                    "presences": []
+                    "presences": self.application.presences.for_users(member["id"] for member in chunk) if payload.get("presences") else []
                 }
 
+                if i == 0 and not_found:
+                    chunk_payload["not_found"] = not_found
+
                 if (nonce := payload.get("nonce")):
-                    payload["nonce"] = nonce
+                    chunk_payload["nonce"] = nonce
 
                 self.push_event("guild_member_chunk", chunk_payload)
 
-    async def heartbeat_task(self):
-        delta = datetime.timedelta(seconds=self.sleep_interval)
+    async def identify(self, payload: dict[str, Any], intents: int, shard_id: int, num_shards: int):
+        # this runs outside of on_message so heartbeats still get handled while waiting to be let in
+        queue = self.application.identify_queue
+        user_id = self.user_id
+        assert user_id is not None  # set when the token checked out, before this task was started
 
-        while True:
-            await self.heartbeat_event.wait()
-            await asyncio.sleep(self.sleep_interval)
-            self.heartbeat_event.clear()
+        if not await queue.consume(user_id):
+            return self.close(GatewayErrors.rate_limited, "Session start limit reached")
+
+        async with queue.admit(user_id, shard_id):
+            async with self.database.accqire(readonly=True) as conn:
+                rows = await self.database.queries.fetch(conn, "get_user_guild_ids", user_id)
+
+            guild_ids = [row["guild_id"] for row in rows if get_shard_id(row["guild_id"], num_shards) == shard_id]
+
+            if len(guild_ids) > self.application.config["gateway"].get("max_guilds_per_shard", 2500):
+                return self.close(GatewayErrors.sharding_required, "Sharding is required")
+
+            await self.application.load_guilds(guild_ids)  # without holding a connection, the load needs one of its own
+
+            async with self.database.accqire(readonly=True) as conn:
+                self.intents = intents
+                session = self.session = self.application.sessions.create(user_id, shard_id, num_shards)
+                session.intents = self.intents
+                session.guild_ids = self.guild_ids
+                self.guild_ids.extend(guild_ids)
+                self.application.gateway_connections.setdefault(user_id, []).append(self)
+
+                self.dispatcher_task = asyncio.create_task(self.dispatcher())
+
+                ready = {
+                    "v": self.gateway_version,
+                    "user": await self.database.get_user(user_id, conn=conn),
+                    "guilds": [{"id": id, "unavailable": True} for id in guild_ids],
+                    "session_id": session.id,
+                    "shard": [shard_id, num_shards],
+                    "application": {
+                        "id": user_id,
+                        "flags": 0
+                    }
+                }
+
+                self.push_event("ready", ready)
 
-            behind = self.last_heartbeat_ack < datetime.datetime.utcnow() - delta
-            
-            if behind:
-                self.close()
+                async for guild in self.database.iter_guilds(guild_ids, conn=conn):
+                    guild["presences"] = self.application.presences.for_users(member["user"]["id"] for member in guild["members"])
+                    self.push_event("guild_create", guild)
+
+        self.update_presence(payload.get("presence") or {"status": "online"})
 
     def on_close(self):
+        self.application.heartbeats.remove(self)
         logging.info("Closing gateway connection with user id %s", self.user_id)
-        if self.user_id is not None:
+        logging.debug("Sent %s bytes (%s uncompressed) to user id %s", self.bytes_sent, self.bytes_raw, self.user_id)
+        for task in (self.identify_task, self.dispatcher_task):
+            if task is not None:
+                task.cancel()
+
+        if self.remove_connection() and self.session is not None:
+            self.application.sessions.detach(self.session)  # kept around for a while so the client can resume
+
+            if self.user_id not in self.application.gateway_connections:
+                self.update_presence({"status": "offline"})  # their last connection is gone
+
+    def update_presence(self, payload: dict[str, Any]):
+        assert self.user_id is not None  # only ever called once identified
+        status = payload["status"]
+        if status == "invisible":
+            status = "offline"  # invisible people look offline to everyone else
+
+        if self.session is not None and payload["status"] != "offline":
+            self.session.presence = payload  # so it can be restored if they resume
+
+        self.application.presences.update(self.user_id, {"status": status, "activities": payload.get("activities") or []})
+
+    def remove_connection(self) -> bool:
+        if self.user_id is None:
+            return False  # never identified so it was never added
+
+        connections = self.application.gateway_connections.get(self.user_id)
+        if connections is None or self not in connections:
+            return False
+
+        connections.remove(self)
+        if not connections:
             del self.application.gateway_connections[self.user_id]
 
+        return True
+
+    async def write_message(self, message: Union[bytes, str, dict[str, Any]], binary: bool = False) -> None:
+        data = self.encoding.dumps(message) if isinstance(message, dict) else message
+        if isinstance(data, str):
+            data = data.encode()
+
+        binary = binary or self.encoding.binary
+
+        self.bytes_raw += len(data)
+
+        if self.compressor is not None:
+            # every frame ends with a sync flush so the client can inflate it as soon as it arrives
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            binary = True
+
+        self.bytes_sent += len(data)
+        return await super().write_message(data, binary=binary)
+
     async def dispatcher(self):
         while True:
-            event_name, payload = await self.queue.get()
-            await self.send_message(GatewayOps.dispatch, payload, s=self.s, t=event_name.upper())
-            self.s += 1
+            s, event = await self.queue.get()
+            await self.write_message(event.frame(s, self.encoding))
+            self.s = s
 
     def push_event(self, event_name: str, payload: dict[str, Any]):
-        self.queue.put_nowait((event_name, payload))
+        self.push_dispatch(DispatchEvent(event_name, payload))
+
+    def push_dispatch(self, event: DispatchEvent):
+        assert self.session is not None
+        self.enqueue(self.session.record(event), event)
+
+    def enqueue(self, s: int, event: DispatchEvent):
+        # the session buffer already has the event, so anything we cant send here can still be replayed after a resume
+        if self.ws_connection is None or self.ws_connection.is_closing():
+            return
+
+        try:
+            self.queue.put_nowait((s, event))
+        except asyncio.QueueFull:
+            self.application.gateway_stats["dropped_events"] += 1
+            return self.close_slow_consumer()
+
+        if self.queue.qsize() < self.high_water:
+            self.high_water_since = None
+        elif self.high_water_since is None:
+            self.high_water_since = time.monotonic()
+        elif time.monotonic() - self.high_water_since > self.slow_consumer_timeout:
+            self.close_slow_consumer()
+
+    def close_slow_consumer(self):
+        logging.warning("Closing slow gateway connection with user id %s, %s events queued", self.user_id, self.queue.qsize())
+        self.application.gateway_stats["slow_consumer_closes"] += 1
+        self.close(GatewayErrors.unknown, "Send buffer full, please resume")
 
 def setup(app):
     return [(f"/api/v{app.version}/gateway/connect", Gateway, app.args)]
@@ -1,5 +1,6 @@
 
 from app.utils import spec, RequestHandler
+import math
 
 class GetGateway(RequestHandler, require_token=False):
     async def get(self):
@@ -7,14 +8,21 @@ class GetGateway(RequestHandler, require_token=False):
 
 class GetBotGateway(RequestHandler):
     async def get(self):
+        async with self.database.accqire(replica=True) as conn:
+            guild_count = await self.database.queries.fetchval(conn, "count_user_guilds", self.user_id)
+
+        guilds_per_shard = self.application.config["gateway"].get("recommended_guilds_per_shard", 1000)
+        identify_queue = self.application.identify_queue
+        limit = await identify_queue.get_limit(self.user_id)
+
         self.finish({
             "url": f"ws://{self.application.config['app']['public_url']}/api/v{self.application.version}/gateway/connect",
-            "shards": 1,  # haha sharding go brrr
+            "shards": max(1, math.ceil(guild_count / guilds_per_shard)),
             "session_start_limit": {
-                "total": 1000,
-                "remaining": 1000,
-                "reset_after": 0,
-                "max_concurrency": 1
+                "total": limit.total,
+                "remaining": limit.remaining,
+                "reset_after": round(limit.get_reset_after() * 1000),
+                "max_concurrency": identify_queue.max_concurrency
             }
         })
 
@@ -22,7 +22,7 @@ class Channels(RequestHandler):
             }
         }, "default": []}
     }, require_all=False)
-    async def post(self, guild_id: str) -> None:
+    async def post(self, guild_id: int) -> None:
         id = self.tokens.create_id()
         name = self.body["name"]
         type = self.body["type"]
@@ -31,12 +31,16 @@ class Channels(RequestHandler):
         user_limit = self.body["user_limit"]
         rate_limit_per_user = self.body["rate_limit_per_user"]
         # position = self.body["position"]  will be handled another time
-        parent_id = self.body["parent_id"]
         nsfw = self.body["nsfw"]
+
+        try:
+            parent_id = int(self.body["parent_id"]) if self.body["parent_id"] is not None else None
+        except ValueError:
+            return self.error(JsonErrors.invalid_form, parent_id="Invalid snowflake.")
         
         async with self.database.accqire() as conn:
             try:
-                channel = await conn.fetchrow("insert into guild_channels values($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11) returning *", name, id, type, topic, bitrate, user_limit, rate_limit_per_user, 0, parent_id, nsfw, guild_id)
+                channel = await self.database.queries.fetchrow(conn, "create_channel", name, id, type, topic, bitrate, user_limit, rate_limit_per_user, 0, parent_id, nsfw, guild_id)
             except asyncpg.exceptions.ForeignKeyViolationError:
                 return self.error(JsonErrors.missing_access)
 
@@ -44,22 +48,20 @@ class Channels(RequestHandler):
 
         self.finish(channel)
 
-        self.application.destinations["channel"][id] = self.application.destinations["guild"][guild_id]  # dont have permissions done yet so this is a botch fix
-
-        self.application.dispatch_event("channel_create", channel, index_type="channel", index=id)
+        self.application.dispatch_event("channel_create", channel, index_type="channel", index=id, guild_id=guild_id)
 
-    async def get(self, guild_id: str):
-        async with self.database.accqire() as conn:
-            channels = await conn.fetch("select * from guild_channels where guild_id=$1", guild_id)
+    async def get(self, guild_id: int):
+        async with self.database.accqire(replica=True) as conn:
+            channels = await self.database.queries.fetch(conn, "get_guild_channels", guild_id)
         
         channels = [filter_channel_keys(dict(channel)) for channel in channels]
 
         self.finish(channels)
 
 class ChannelID(RequestHandler):
-    async def delete(self, channel_id: str):
+    async def delete(self, channel_id: int):
         async with self.database.accqire() as conn:
-            channel = await conn.fetchrow("delete from guild_channels where id=$1 return *", channel_id)
+            channel = await self.database.queries.fetchrow(conn, "delete_channel", channel_id)
         
         if not channel:
             return self.error(JsonErrors.missing_access, 403)
@@ -69,8 +71,7 @@ class ChannelID(RequestHandler):
 
         channel = filter_channel_keys(channel)
 
-        self.application.dispatch_event("channel_delete", channel, index=channel_id, index_type="channel")
-        del self.application.destinations["channel"][channel_id]
+        self.application.dispatch_event("channel_delete", channel, index=channel_id, index_type="channel", guild_id=channel["guild_id"])
 
 def setup(app):
-    return [(f"/api/v{app.version}/guilds/(.+)/channels", Channels, app.args)]
+    return [(f"/api/v{app.version}/guilds/(?P<guild_id>[0-9]+)/channels", Channels, app.args)]
@@ -49,10 +49,9 @@ class Guild(RequestHandler):
         now = datetime.datetime.utcnow().isoformat()
 
         async with self.database.accqire() as conn:
-            guild = await conn.fetchrow("insert into guilds(name, id, owner_id, verification_level, default_message_notifications, explicit_content_filter) values($1, $2, $3, $4, $5, $6) returning *",
-                                        name, guild_id, self.user_id, verification_level, default_message_notifications, explicit_content_filter)
+            guild = await self.database.queries.fetchrow(conn, "create_guild", name, guild_id, self.user_id, verification_level, default_message_notifications, explicit_content_filter)
 
-            member = await conn.fetchrow("insert into guild_members(user_id, guild_id, joined_at) values ($1, $2, $3) returning *", self.user_id, guild_id, now)
+            member = await self.database.queries.fetchrow(conn, "create_member", self.user_id, guild_id, now)
             user = await self.database.get_user(self.user_id, conn=conn)
 
         # TODO: do roles and channels
@@ -74,22 +73,12 @@ class Guild(RequestHandler):
         guild["presences"] = []
         guild["member_count"] = 1
 
-        member = {
-            "id": self.user_id,
-            "nick": None,
-            "mute": False,
-            "deaf": False,
-            "joined_at": now
-        }
-
-        self.application.member_cache[guild_id] = {self.user_id: member}
-        self.application.destinations["guild"][guild_id] = [self.user_id]
         self.application.dispatch_event("guild_create", guild, index=guild_id, index_type="guild")
 
 class GuildID(RequestHandler):
-    async def get(self, guild_id: str) -> None:
-        async with self.database.accqire() as conn:
-            guild = await conn.fetchrow("select * from guilds where id=$1 and exists (select 1 from guild_members where guild_id=$1 and user_id=$2)", guild_id, self.user_id)
+    async def get(self, guild_id: int) -> None:
+        async with self.database.accqire(readonly=True) as conn:  # not the replica, this is also the membership check
+            guild = await self.database.queries.fetchrow(conn, "get_member_guild", guild_id, self.user_id)
         
             if guild is None:
                 return self.error(JsonErrors.missing_key, 403)
@@ -106,7 +95,7 @@ class GuildID(RequestHandler):
         "owner_id": {"type": "string"},
         "description": {"type": "string", "nullable": True}
     }, require_all=False)
-    async def patch(self, guild_id: str) -> None:
+    async def patch(self, guild_id: int) -> None:
         async with self.database.accqire() as conn:
             new_guild = await conn.fetchrow("""update guilds set
                 name=coalesce($2, name),
@@ -124,21 +113,20 @@ class GuildID(RequestHandler):
         self.finish(new_guild)
         self.application.dispatch_event("guild_update", new_guild, index=guild_id, index_type="guild")
 
-    async def delete(self, guild_id: str) -> None:
+    async def delete(self, guild_id: int) -> None:
         async with self.database.accqire() as conn:
-            response = await conn.execute("delete from guilds where id=$1 and owner_id=$2", guild_id, self.user_id)
+            response = await self.database.queries.execute(conn, "delete_guild", guild_id, self.user_id)
         
-        if response == "0":
+        if response == "DELETE 0":
             return self.error(JsonErrors.missing_access, 403)
 
         self.set_status(204)
         self.flush()
 
         self.application.dispatch_event("guild_delete", {"id": guild_id, "unavailable": False}, index=guild_id, index_type="guild")
-        del self.application.destinations["guild"][guild_id]
 
 def setup(app):
     return [
         (f"/api/v{app.version}/guilds", Guild, app.args),
-        (f"/api/v{app.version}/guilds/(.+)", GuildID, app.args),
+        (f"/api/v{app.version}/guilds/(?P<guild_id>[0-9]+)", GuildID, app.args),
     ]
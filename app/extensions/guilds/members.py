@@ -1,53 +1,41 @@
-
 from app.utils import spec, RequestHandler, JsonErrors
 
 class SpecificMembers(RequestHandler):
-    async def get(self, guild_id: str, member_id: str):
-        async with self.database.accqire() as conn:
-            control = await conn.fetchval("select 1 from guild_members where guild_id=$1 and user_id=$2", guild_id, self.user_id)
-            member = await conn.fetchrow("select joined_at, deaf, mute, pending, nick from guild_members where guild_id=$1 and user_id=$2", guild_id, member_id)
-
-            if not control:
-                return self.error(JsonErrors.missing_access, 403)
-            if not member:
-                return self.error(JsonErrors.unknown_user, 404)
- 
-            member = dict(member)
-            member["user"] = await self.database.get_user(member_id)
-            member["roles"] = await self.database.get_member_roles(member_id, guild_id, conn=conn)
-
-        self.finish(member)
+    async def get(self, guild_id: int, member_id: int):
+        async with self.database.accqire(readonly=True) as conn:  # membership is checked on the primary, the replica could still have someone who was just removed
+            control = await self.database.queries.fetchval(conn, "is_member", guild_id, self.user_id)
+
+        if not control:
+            return self.error(JsonErrors.missing_access, 403)
+
+        members = await self.database.get_members(guild_id, user_ids=[member_id], replica=True)
+        if not members:
+            return self.error(JsonErrors.unknown_user, 404)
+
+        self.finish(members[0])
 
 class Members(RequestHandler):
-    async def get(self, guild_id: str):
+    async def get(self, guild_id: int):
         try:
             limit = int(self.get_query_argument("limit", 1))
-            after = str(int(self.get_query_argument("after", 0)))
+            after = int(self.get_query_argument("after", 0))
         except ValueError:
             return ...
 
-        async with self.database.accqire() as conn:
-            count = await conn.fetchval("select 1 from guild_members where guild_id=$1 and user_id=$2", guild_id, self.user_id)
-            if count == 0:
-                return self.error(JsonErrors.missing_access, 403)
+        limit = max(1, min(limit, 1000))
+
+        async with self.database.accqire(readonly=True) as conn:
+            control = await self.database.queries.fetchval(conn, "is_member", guild_id, self.user_id)
 
-            user_rows = await conn.fetch("select user_id, joined_at, deaf, mute, pending, nick from guild_members where guild_id=$1 and user_id > $2 order by user_id asc limit $3", guild_id, after, limit)
-            
-            members = []
+        if not control:
+            return self.error(JsonErrors.missing_access, 403)
 
-            for row in user_rows:
-                member = dict(row)
-                user_id = member.pop("user_id")
+        members = await self.database.get_members(guild_id, after=after, limit=limit, replica=True)
 
-                member["user"] = await self.database.get_user(user_id, conn=conn)
-                member["roles"] = await self.database.get_member_roles(user_id, guild_id, conn=conn)
-                members.append(member)
-            
         self.finish(members)
 
 def setup(app):
     return [
-        (f"/api/v{app.version}/guilds/(.+)/members/(.+)", SpecificMembers, app.args),
-        (f"/api/v{app.version}/guilds/(.+)/members", Members, app.args)
+        (f"/api/v{app.version}/guilds/(?P<guild_id>[0-9]+)/members/(?P<member_id>[0-9]+)", SpecificMembers, app.args),
+        (f"/api/v{app.version}/guilds/(?P<guild_id>[0-9]+)/members", Members, app.args)
     ]
-
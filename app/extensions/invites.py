@@ -2,6 +2,7 @@
 from asyncpg.exceptions import DatetimeFieldOverflowError
 from app.utils import spec, RequestHandler, JsonErrors
 import datetime
+from typing import Any
 
 class Invites(RequestHandler):
     async def get(self, invite_code: str):
@@ -14,7 +15,7 @@ class Invites(RequestHandler):
 
     async def delete(self, invite_code: str):
         async with self.database.accqire() as conn:
-            invite = await conn.fetchrow(f"delete from guild_invites where code=$1 returning channel_id, guild_id, inviter_id", invite_code)
+            invite = await self.database.queries.fetchrow(conn, "delete_invite", invite_code)
 
             if not invite:
                 return self.error(JsonErrors.unknown_invite, 404)
@@ -39,9 +40,9 @@ class Invites(RequestHandler):
             except:
                 return self.error(JsonErrors.unknown_invite, 404)
 
-            guild = await self.database.get_guild(invite["guild"]["id"], partial=True)
-            channel = await self.database.get_channel(invite["channel"]["id"], partial=True)
-            user = await self.database.get_user(invite["inviter"]["id"])
+            guild = await self.database.get_guild(invite["guild"]["id"], conn=conn, partial=True)
+            channel = await self.database.get_channel(invite["channel"]["id"], conn=conn, partial=True)
+            user = await self.database.get_user(invite["inviter"]["id"], conn=conn)
 
             payload = {
                 "code": invite_code,
@@ -54,21 +55,20 @@ class Invites(RequestHandler):
 
             now = datetime.datetime.utcnow().isoformat()
 
-            member = await conn.fetchrow("insert into guild_members(user_id, guild_id, joined_at) values($1, $2, $3) returning nick, joined_at, deaf, mute", self.user_id, guild["id"], now)
+            row = await self.database.queries.fetchrow(conn, "join_guild", self.user_id, guild["id"], now)
 
-            member = dict(member)  # type: ignore
-            member["user"] = user
-            member["roles"] = []            
+            member: dict[str, Any] = dict(row)  # type: ignore
+            member["user"] = await self.database.get_user(self.user_id, conn=conn)  # the person joining, user is who made the invite
+            member["roles"] = []
+            member["guild_id"] = guild["id"]
 
-            guild = await self.database.get_guild(invite["guild"]["id"], extra_info=True)
+            guild = await self.database.get_guild(invite["guild"]["id"], conn=conn, extra_info=True)
 
         guild["pending"] = False
         guild["joined_at"] = now
 
-        self.application.send_event("guild_create", self.user_id, guild)
+        self.application.send_event("guild_create", self.user_id, guild, guild_id=guild["id"])
         self.application.dispatch_event("guild_member_add", member, index=guild["id"], index_type="guild")
 
-        self.application.destinations["guild"][guild["id"]].append(self.user_id)
-
 def setup(app):
     return [(f"/api/v{app.version}/invites/(.+)", Invites, app.args)]
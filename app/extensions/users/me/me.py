@@ -3,8 +3,8 @@ from app.utils import spec, RequestHandler
 
 class Me(RequestHandler):
     async def get(self):
-        async with self.database.accqire() as conn:
-            row = await conn.fetchrow("select username, discriminator, id from users where id=$1", self.user_id)
+        async with self.database.accqire(replica=True) as conn:
+            row = await self.database.queries.fetchrow(conn, "get_user", self.user_id)
 
         user = dict(row)  # type: ignore
 
@@ -1,10 +1,23 @@
-from .database import DB, now
+from .database import DB, now, connection_args
 from .errors import CustomError
 from .route import RequestHandler, WebSocketHandler
 from .validator import spec, Spec, Validator
 from .loop import TornadoUvloop
 from .token import Tokens
-from .enums import ChannelType, GatewayErrors, GatewayOps, JsonErrors, HTTPErrors, MessageTypes
-from .misc import filter_channel_keys
+from .enums import ChannelType, GatewayErrors, GatewayOps, GatewayIntents, JsonErrors, HTTPErrors, MessageTypes
+from .misc import filter_channel_keys, get_shard_id
 from .specs import embed_spec, allowed_mentions_spec
 from .ratelimits import ratelimit, RatelimitMapping
+from .events import DispatchEvent
+from .encoding import Encoding, encodings
+from .sessions import Session, SessionStore
+from .bus import EventBus, create_bus
+from .heartbeats import HeartbeatSupervisor
+from .members import MemberIndex, GuildMembers, UserCache
+from .presences import PresenceStore
+from .identify import IdentifyQueue
+from .queries import QueryCatalog
+from .cache import EntityCache
+from .writer import MessageWriter
+from .partitions import create_partitions, detach_partitions, archive_partitions
+from .snowflakes import snowflake, stringify_ids
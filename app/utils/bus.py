@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import secrets
+import struct
+import ujson
+import asyncpg
+from typing import Any, Callable, Optional
+
+from .snowflakes import isoformat_datetimes
+
+BusCallback = Callable[[dict[str, Any]], None]
+
+class EventBus:
+    # the default bus, only this process gets the events so its fine for a single worker
+
+    def __init__(self, callback: BusCallback):
+        self.callback = callback
+
+    async def start(self):
+        pass
+
+    def publish(self, message: dict[str, Any]):
+        self.callback(message)  # this worker always handles its own events straight away
+        self.forward(message)
+
+    def forward(self, message: dict[str, Any]):
+        pass
+
+class UnixBus(EventBus):
+    # the first worker to start becomes the broker, every other worker connects to it and the broker relays each frame to everyone else
+
+    header = struct.Struct(">I")
+
+    def __init__(self, callback: BusCallback, path: str):
+        super().__init__(callback)
+        self.path = "\0" + path[1:] if path.startswith("@") else path  # @name is an abstract socket so a dead broker never leaves a stale file behind
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        await self.connect()
+
+    async def connect(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await self.serve()
+                continue
+
+            self.writer = writer
+            asyncio.create_task(self.receive(reader))
+            return
+
+    async def serve(self):
+        try:
+            self.server = await asyncio.start_unix_server(self.relay, path=self.path)
+            logging.info("Started event bus broker at %r", self.path)
+        except OSError:
+            await asyncio.sleep(0.1)  # another worker beat us to it, connect to theirs instead
+
+    async def relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+
+        try:
+            while True:
+                header = await reader.readexactly(self.header.size)
+                frame = header + await reader.readexactly(self.header.unpack(header)[0])
+
+                for client in self.clients:
+                    if client is not writer:
+                        client.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+
+    async def receive(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                size, = self.header.unpack(await reader.readexactly(self.header.size))
+                self.callback(ujson.loads(await reader.readexactly(size)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.warning("Lost connection to the event bus broker, reconnecting")
+            self.writer = None
+            await self.connect()
+
+    def forward(self, message: dict[str, Any]):
+        if self.writer is None:
+            logging.warning("Not connected to the event bus broker, event %s was only handled by this worker", message["event"])
+            return
+
+        data = ujson.dumps(isoformat_datetimes(message)).encode()  # what the other workers get has to encode the same as what this one has
+        self.writer.write(self.header.pack(len(data)) + data)
+
+class PostgresBus(EventBus):
+    # notify payloads are capped at 8000 bytes so anything bigger goes through the event_bus table and only its id is sent
+
+    max_notify_size = 7900
+
+    def __init__(self, callback: BusCallback, database_args: dict[str, Any], channel: str):
+        super().__init__(callback)
+        self.database_args = database_args
+        self.channel = channel
+        self.worker_id = secrets.token_hex(8)  # postgres sends notifications back to us too, this is how we skip them
+
+        self.outgoing = asyncio.Queue[str]()
+        self.incoming = asyncio.Queue[str]()
+
+    async def start(self):
+        self.listener: asyncpg.Connection = await asyncpg.connect(**self.database_args)
+        self.publisher: asyncpg.Connection = await asyncpg.connect(**self.database_args)
+        await self.listener.add_listener(self.channel, self.on_notify)
+
+        # both directions go through a single task each so events keep their order
+        asyncio.create_task(self.send_task())
+        asyncio.create_task(self.receive_task())
+
+    def on_notify(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str):
+        self.incoming.put_nowait(payload)
+
+    async def send_task(self):
+        while True:
+            data = await self.outgoing.get()
+
+            try:
+                if len(data.encode()) > self.max_notify_size:
+                    row_id = await self.publisher.fetchval("insert into event_bus(payload) values($1) returning id", data)
+                    await self.publisher.execute("delete from event_bus where created_at < now() - interval '1 minute'")
+                    data = f"@{row_id}"
+
+                await self.publisher.execute("select pg_notify($1, $2)", self.channel, f"{self.worker_id} {data}")
+            except asyncpg.PostgresError:
+                logging.exception("Failed to publish event to the event bus")
+
+    async def receive_task(self):
+        while True:
+            worker_id, data = (await self.incoming.get()).split(" ", 1)
+            if worker_id == self.worker_id:
+                continue
+
+            if data.startswith("@"):
+                data = await self.listener.fetchval("select payload from event_bus where id=$1", int(data[1:]))
+                if data is None:
+                    continue
+
+            self.callback(ujson.loads(data))
+
+    def forward(self, message: dict[str, Any]):
+        self.outgoing.put_nowait(ujson.dumps(isoformat_datetimes(message)))
+
+def create_bus(config: dict[str, Any], callback: BusCallback, database_args: dict[str, Any]) -> EventBus:
+    backend = config.get("backend", "local")
+
+    if backend == "local":
+        return EventBus(callback)
+    elif backend == "unix":
+        return UnixBus(callback, config.get("path", "@bestcord-bus"))
+    elif backend == "postgres":
+        return PostgresBus(callback, database_args, config.get("channel", "bestcord_events"))
+
+    raise ValueError(f"Unknown event bus backend '{backend}'")
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import collections
+import time
+from typing import Any, Optional
+
+class EntityCache:
+    # a bounded lru of database rows by id, entries are dropped when an event says they changed
+    # and the ttl is only a backstop for anything that changes without one
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries: collections.OrderedDict[int, tuple[float, dict[str, Any]]] = collections.OrderedDict()  # id -> (expires at, row)
+        self.generation = 0  # bumped on every invalidation so a fetch that raced one doesnt put the stale row back
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: int) -> Optional[dict[str, Any]]:
+        entry = self.entries.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: int, value: dict[str, Any], generation: int):
+        if generation != self.generation:
+            return
+
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: int):
+        self.generation += 1
+        self.entries.pop(key, None)
+
+    def get_hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any], name: str) -> EntityCache:
+        return cls(config.get(f"{name}_size", 10000), config.get("ttl", 300))
@@ -2,67 +2,166 @@ from __future__ import annotations
 
 import asyncpg
 import contextlib
+import functools
+import logging
+import time
 import argon2
 import ujson
-from typing import Any, Optional, cast
+from typing import Any, AsyncIterator, Optional, cast
 import datetime
 
 from .errors import CustomError
 from .misc import filter_channel_keys
+from .queries import QueryCatalog, QueryName, QueryStats, queries as all_queries
+from .cache import EntityCache
 
 all_discrims: set[str] = set(str(d).rjust(4, "0") for d in range(1, 1000))
+partial_guild_keys = ("id", "name", "splash", "banner", "description", "icon", "features", "verification_level", "vanity_url_code", "nsfw")
+partial_channel_keys = ("id", "name", "type")
+
+pool_keys = ("min_size", "max_size", "slow_query_threshold", "replica_dsn")  # [database] keys that arent connection arguments
 
 def now() -> str:
     return datetime.datetime.utcnow().isoformat()
 
+def connection_args(config: dict[str, Any]) -> dict[str, Any]:
+    return {key: value for key, value in config.items() if key not in pool_keys}
+
 class DB:
-    def __init__(self, pool: asyncpg.Pool):
+    def __init__(self, pool: asyncpg.Pool, queries: Optional[QueryCatalog] = None, cache_config: Optional[dict[str, Any]] = None, replica: Optional[asyncpg.Pool] = None,
+                 min_size: int = 10, max_size: int = 10):
         self.pool = pool
+        self.replica = replica
+        self.min_size = min_size
+        self.max_size = max_size
+        self.queries = queries or QueryCatalog(all_queries)  # the same catalog the pool's connections prepared, see from_args
         self.hasher = argon2.PasswordHasher()
 
+        cache_config = cache_config or {}
+        self.users = EntityCache.from_config(cache_config, "users")
+        self.channels = EntityCache.from_config(cache_config, "channels")
+        self.guilds = EntityCache.from_config(cache_config, "guilds")
+
+        self.acquire_stats = QueryStats()  # time spent waiting for a connection from the pool
+        self.transaction_stats = QueryStats()  # time from begin to commit or rollback
+        self.waiting = 0
+        self.in_use: dict[asyncpg.Pool, int] = {pool: 0}  # counted here since asyncpg 0.23 pools cant tell us
+        if replica is not None:
+            self.in_use[replica] = 0
+
     @staticmethod
-    async def connection_init(connection: asyncpg.Connection) -> asyncpg.Connection:
+    async def connection_init(queries: QueryCatalog, connection: asyncpg.Connection) -> asyncpg.Connection:
         await connection.set_type_codec("json", encoder=ujson.dumps, decoder=ujson.loads, schema="pg_catalog")
+        await queries.prepare(connection)
         return connection
 
     @classmethod
-    async def from_args(cls, args: dict[str, str]):
-        pool = await asyncpg.create_pool(**args, init=cls.connection_init)
+    async def from_args(cls, args: dict[str, Any], cache_config: Optional[dict[str, Any]] = None):
+        queries = QueryCatalog(all_queries, args.get("slow_query_threshold", 100) / 1000)
+        init = functools.partial(cls.connection_init, queries)
+        min_size, max_size = args.get("min_size", 10), args.get("max_size", 10)
+        pool = await asyncpg.create_pool(**connection_args(args), min_size=min_size, max_size=max_size, init=init)
         assert pool
-        return cls(pool)
 
-    @contextlib.asynccontextmanager
-    async def accqire(self, conn: Optional[asyncpg.Connection] = None):
-        release = True
+        replica = None
+        if (dsn := args.get("replica_dsn")):
+            replica = await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size, init=init)
+
+        return cls(pool, queries, cache_config=cache_config, replica=replica, min_size=min_size, max_size=max_size)
+
+    async def _acquire(self, pool: asyncpg.Pool) -> asyncpg.Connection:
+        in_use, waiting = self.in_use[pool], self.waiting  # what we were stuck behind, not what is left once we got one
+        self.waiting += 1
+        start = time.perf_counter()
 
         try:
-            if conn is None:
-                conn = cast(asyncpg.Connection, await self.pool.acquire())
-            else:
-                release = False  # we are already in a context manager so i wont release it here
+            conn = cast(asyncpg.Connection, await pool.acquire())
+        finally:
+            self.waiting -= 1
+
+        self.in_use[pool] += 1
+        waited = time.perf_counter() - start
+        self.acquire_stats.record(waited)
+
+        if waited > self.queries.slow_threshold:
+            logging.warning("Waited %.1fms for a database connection (%s in use, %s waiting)", waited * 1000, in_use, waiting)
+
+        return conn
+
+    async def _release(self, pool: asyncpg.Pool, conn: asyncpg.Connection):
+        self.in_use[pool] -= 1
+        await pool.release(conn)
+
+    def get_pool_stats(self) -> dict[str, Any]:
+        return {
+            "replica": self.replica is not None,
+            "replica_in_use": self.in_use[self.replica] if self.replica is not None else 0,
+            "in_use": self.in_use[self.pool],
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "waiting": self.waiting,
+            "acquires": self.acquire_stats.calls,
+            "acquire_wait_max": self.acquire_stats.max,
+            "acquire_wait_avg": self.acquire_stats.total / self.acquire_stats.calls if self.acquire_stats.calls else 0.0,
+            "transactions": self.transaction_stats.calls,
+            "transaction_max": self.transaction_stats.max,
+            "transaction_avg": self.transaction_stats.total / self.transaction_stats.calls if self.transaction_stats.calls else 0.0
+        }
 
-            transaction = conn.transaction()
-            if transaction._managed:
+    @contextlib.asynccontextmanager
+    async def accqire(self, conn: Optional[asyncpg.Connection] = None, *, readonly: bool = False, replica: bool = False):
+        # readonly is for reads that dont need a transaction around them, that saves the begin and commit round trips.
+        # replica reads also go to the read replica when there is one, only use it where a read lagging a little behind a write is fine
+        pool = self.replica if replica and self.replica is not None else self.pool
+        readonly = readonly or replica
+        release = conn is None  # otherwise we are already in a context manager so i wont release it here
+
+        if conn is None:
+            conn = await self._acquire(pool)
 
-                yield conn
+        try:
+            if readonly or conn.is_in_transaction():
+                yield conn  # anything already in a transaction is covered by it, no need for a savepoint
             else:
-                async with transaction:
-                    yield conn
+                start = time.perf_counter()
+                try:
+                    async with conn.transaction():
+                        yield conn
+                finally:
+                    self.transaction_stats.record(time.perf_counter() - start)
         finally:
             if release:
-                await self.pool.release(conn)
+                await self._release(pool, conn)
+
+    async def _get_cached(self, cache: EntityCache, query: QueryName, key: int, conn: Optional[asyncpg.Connection]) -> dict[str, Any]:
+        # hits dont touch the pool at all, callers get the cached row itself so they have to copy it before changing anything
+        row = cache.get(key)
+
+        if row is None:
+            generation = cache.generation
+
+            async with self.accqire(conn, readonly=True) as conn:  # not the replica, a lagging read would get cached past its invalidation
+                record = await self.queries.fetchrow(conn, query, key)
+
+            if not record:
+                raise CustomError
+
+            row = dict(record)
+            cache.set(key, row, generation)
 
-    async def create_account(self, username: str, email: str, password: str, id: str) -> dict[str, Any]:
+        return row
+
+    async def create_account(self, username: str, email: str, password: str, id: int) -> dict[str, Any]:
         async with self.accqire() as conn:
             hashed = self.hasher.hash(password)
 
-            users = await conn.fetch("select discriminator from users where username=$1", username)
+            users = await self.queries.fetch(conn, "get_discriminators", username)
             discrims = [row["discriminator"] for row in users]
             diff = iter(all_discrims - set(discrims))
             discrim = next(diff)
 
             try:
-                await conn.execute("insert into users(id, username, hashed_password, email, discriminator) values($1, $2, $3, $4, $5)", id, username, hashed, email, discrim)
+                await self.queries.execute(conn, "create_user", id, username, hashed, email, discrim)
             except asyncpg.exceptions.UniqueViolationError:
                 raise CustomError
 
@@ -70,7 +169,7 @@ class DB:
 
     async def get_account(self, email, password, *, with_settings=False):
         async with self.accqire() as conn:
-            row = await conn.fetchrow("select * from users where email=$1", email)
+            row = await self.queries.fetchrow(conn, "get_user_by_email", email)
 
             if not row:
                 raise CustomError
@@ -82,89 +181,143 @@ class DB:
             row = dict(row)
 
             if with_settings:
-                user_settings = await conn.fetchrow("select locale, theme from user_settings where user_id=$1", row["id"])
+                user_settings = await self.queries.fetchrow(conn, "get_user_settings", row["id"])
                 if not user_settings:
-                    user_settings = await conn.fetchrow("insert into user_settings(user_id) values ($1) returning theme, locale;", row["id"])
+                    user_settings = await self.queries.fetchrow(conn, "create_user_settings", row["id"])
 
                 row["user_settings"] = dict(user_settings)  # type: ignore
 
             return row
 
-    async def get_channel(self, channel_id: str, *, conn: Optional[asyncpg.Connection] = None, partial: bool = False) -> dict[str, Any]:
+    async def get_channel(self, channel_id: int, *, conn: Optional[asyncpg.Connection] = None, partial: bool = False) -> dict[str, Any]:
+        row = await self._get_cached(self.channels, "get_channel", channel_id, conn)
+
         if partial:
-            columns = "id, name, type"
-        else:
-            columns = "*"
+            return {key: row[key] for key in partial_channel_keys}
 
-        async with self.accqire(conn) as conn:
-            row = await conn.fetchrow(f"select {columns} from guild_channels where id=$1", channel_id)
-        
-        if not row:
-            raise CustomError
-        
         return filter_channel_keys(row)
 
-    async def get_guild(self, guild_id: str, *, conn: Optional[asyncpg.Connection] = None, partial: bool = False, extra_info: bool = False) -> dict[str, Any]:
+    async def get_guild(self, guild_id: int, *, conn: Optional[asyncpg.Connection] = None, partial: bool = False, extra_info: bool = False) -> dict[str, Any]:
         if extra_info:
             partial = True
 
+        row = await self._get_cached(self.guilds, "get_guild", guild_id, conn)
+
         if partial:
-            columns = "id, name, splash, banner, description, icon, features, verification_level, vanity_url_code, nsfw"
+            guild = {key: row[key] for key in partial_guild_keys}
         else:
-            columns = "*"
-
-        async with self.accqire(conn) as conn:
-            row = await conn.fetchrow(f"select {columns} from guilds where id=$1", guild_id)
-
-            if not row:
-                raise CustomError
-
             guild = dict(row)
 
-            if extra_info:
-                channels = await conn.fetch("select * from guild_channels where guild_id=$1", guild_id)
-                guild["channels"] = [filter_channel_keys(channel) for channel in channels]
-
-                roles = await conn.fetch("select id, name, color, hoist, position, permissions, managed, mentionable from guild_roles where guild_id=$1", guild_id)
-                guild["roles"] = [dict(role) for role in roles]
-        
-                member_rows = await conn.fetch("select user_id, joined_at, deaf, mute, pending, nick from guild_members where guild_id=$1", guild_id)
-                members = []
+        if extra_info:
+            async with self.accqire(conn, readonly=True) as conn:
+                await self._fill_guilds({guild_id: guild}, conn=conn)
 
-                for row in member_rows:
-                    member = dict(row)
-                    user_id = member.pop("user_id")
-                    member["user"] = await self.get_user(user_id)
-                    member["roles"] = await self.get_member_roles(user_id, guild_id)
-                    members.append(member)
+        return guild
 
-                guild["members"] = members
+    async def iter_guilds(self, guild_ids: list[int], *, conn: Optional[asyncpg.Connection] = None, batch_size: int = 50) -> AsyncIterator[dict[str, Any]]:
+        # same as get_guild with extra_info but a whole batch of guilds is loaded with a handful of queries
+        async with self.accqire(conn, readonly=True) as conn:
+            for i in range(0, len(guild_ids), batch_size):
+                rows = await self.queries.fetch(conn, "get_partial_guilds", guild_ids[i:i + batch_size])
+                guilds = {row["id"]: dict(row) for row in rows}
+
+                await self._fill_guilds(guilds, conn=conn)
+
+                for guild in guilds.values():
+                    yield guild
+
+    async def _fill_guilds(self, guilds: dict[int, dict[str, Any]], *, conn: asyncpg.Connection):
+        guild_ids = list(guilds)
+
+        for guild in guilds.values():
+            guild["channels"] = []
+            guild["roles"] = []
+            guild["members"] = []
+
+        channels = await self.queries.fetch(conn, "get_guilds_channels", guild_ids)
+        for channel in channels:
+            guilds[channel["guild_id"]]["channels"].append(filter_channel_keys(channel))
+
+        roles = await self.queries.fetch(conn, "get_guilds_roles", guild_ids)
+        for role in roles:
+            role = dict(role)
+            guilds[role.pop("guild_id")]["roles"].append(role)
+
+        member_roles: dict[tuple[int, int], list[dict[str, Any]]] = {}  # (guildid, userid) -> roles
+        role_rows = await self.queries.fetch(conn, "get_guilds_member_roles", guild_ids)
+        for role in role_rows:
+            role = dict(role)
+            member_roles.setdefault((role.pop("guild_id"), role.pop("user_id")), []).append(role)
+
+        member_rows = await self.queries.fetch(conn, "get_guilds_members", guild_ids)
+        for row in member_rows:
+            guilds[row["guild_id"]]["members"].append({
+                "joined_at": row["joined_at"],
+                "deaf": row["deaf"],
+                "mute": row["mute"],
+                "pending": row["pending"],
+                "nick": row["nick"],
+                "user": {"username": row["username"], "discriminator": row["discriminator"], "id": row["user_id"], "avatar": row["avatar"]},
+                "roles": member_roles.get((row["guild_id"], row["user_id"]), [])
+            })
+
+    async def get_members(self, guild_id: int, *, after: int = 0, limit: int = 1, user_ids: Optional[list[int]] = None, conn: Optional[asyncpg.Connection] = None,
+                          replica: bool = False) -> list[dict[str, Any]]:
+        # one query per page, the roles get aggregated per member by postgres instead of fetched one member at a time
+        # pages are keyset paginated on user_id so going deep into a big guild costs the same as the first page
+        # only listings should pass replica, anything deciding whether someone is a member has to see the latest joins and removals
+        async with self.accqire(conn, readonly=True, replica=replica) as conn:
+            if user_ids is None:
+                rows = await self.queries.fetch(conn, "get_members_after", guild_id, after, limit)
+            else:
+                rows = await self.queries.fetch(conn, "get_members_by_id", guild_id, user_ids, limit)
+
+        return [{
+            "joined_at": row["joined_at"],
+            "deaf": row["deaf"],
+            "mute": row["mute"],
+            "pending": row["pending"],
+            "nick": row["nick"],
+            "user": {"username": row["username"], "discriminator": row["discriminator"], "id": row["user_id"], "avatar": row["avatar"]},
+            "roles": row["roles"]
+        } for row in rows]
+
+    async def get_messages(self, channel_id: int, *, limit: int = 50, before: Optional[int] = None, after: Optional[int] = None, around: Optional[int] = None,
+                           conn: Optional[asyncpg.Connection] = None) -> list[dict[str, Any]]:
+        # keyset pages off the (channel_id, id) index, newest first like discord no matter which direction was asked for
+        async with self.accqire(conn, replica=True) as conn:
+            if before is not None:
+                rows = await self.queries.fetch(conn, "get_messages_before", channel_id, before, limit)
+            elif after is not None:
+                rows = await self.queries.fetch(conn, "get_messages_after", channel_id, after, limit)
+            elif around is not None:
+                rows = await self.queries.fetch(conn, "get_messages_around", channel_id, around, (limit + 1) // 2, limit // 2)
+            else:
+                rows = await self.queries.fetch(conn, "get_messages", channel_id, limit)
 
-        return guild
+        messages = [dict(row) for row in rows]
+        if after is not None or around is not None:
+            messages.sort(key=lambda message: message["id"], reverse=True)
 
-    async def get_guild_id_from_channel_id(self, channel_id: str, *, conn: Optional[asyncpg.Connection] = None) -> str:
-        async with self.accqire(conn) as conn:
-            guild_id: Optional[str] = await conn.fetchval("select guild_id from guild_channels where id=$1", channel_id)
-            
-            if not guild_id:
-                raise CustomError
-            
-            return guild_id
+        return messages
 
-    async def get_user(self, user_id: str, *, conn: Optional[asyncpg.Connection] = None) -> dict[str, Any]:
-        async with self.accqire(conn) as conn:
-            user = await conn.fetchrow("select username, discriminator, id, avatar from users where id=$1", user_id)
+    async def get_guild_id_from_channel_id(self, channel_id: int, *, conn: Optional[asyncpg.Connection] = None) -> int:
+        channel = await self._get_cached(self.channels, "get_channel", channel_id, conn)
+        guild_id: Optional[int] = channel["guild_id"]
 
-        if not user:
+        if not guild_id:
             raise CustomError
 
-        return dict(user)
+        return guild_id
+
+    async def get_user(self, user_id: int, *, conn: Optional[asyncpg.Connection] = None) -> dict[str, Any]:
+        return dict(await self._get_cached(self.users, "get_user", user_id, conn))
 
     async def get_invite(self, invite_code, *, conn: Optional[asyncpg.Connection] = None, with_counts: bool = False, with_expiration: bool = False) -> dict[str, Any]:
         # todo: actually do something with with_counts
 
-        async with self.accqire(conn) as conn:
-            invite = await conn.fetchrow(f"select channel_id, guild_id, inviter_id {', expires_at' if with_expiration else ''} from guild_invites where code=$1", invite_code)
+        async with self.accqire(conn, readonly=True) as conn:
+            invite = await self.queries.fetchrow(conn, "get_invite", invite_code)
 
             if not invite:
                 raise CustomError
@@ -185,8 +338,8 @@ class DB:
 
         return payload
 
-    async def get_member_roles(self, member_id: str, guild_id: str, *, conn: Optional[asyncpg.Connection] = None) -> list[dict[str, Any]]:
-        async with self.accqire(conn) as conn:
-            rows = await conn.fetch("select id, name, color, hoist, position, permissions, managed, mentionable from guild_roles inner join member_roles on member_roles.user_id=guild_roles.id where member_roles.user_id=$1 and member_roles.guild_id=$2", member_id, guild_id)
+    async def get_member_roles(self, member_id: int, guild_id: int, *, conn: Optional[asyncpg.Connection] = None) -> list[dict[str, Any]]:
+        async with self.accqire(conn, readonly=True) as conn:
+            rows = await self.queries.fetch(conn, "get_member_roles", member_id, guild_id)
 
         return [dict(row) for row in rows]
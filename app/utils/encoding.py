@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import datetime
+import struct
+import ujson
+from typing import Any, Union
+
+from .enums import GatewayOps
+from .snowflakes import stringify_ids
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, encoding=msgpack just wont be offered without it
+    msgpack = None
+
+class Encoding:
+    name: str
+    binary: bool
+
+    def dumps(self, data: Any) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        raise NotImplementedError
+
+    # dispatch frames are split into a head which is shared between every connection and a tail holding the sequence number
+
+    def dispatch_head(self, event_name: str, payload: Any) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def dispatch_tail(self, s: int) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def __repr__(self) -> str:
+        return f"<Encoding {self.name=}>"
+
+class JSONEncoding(Encoding):
+    name = "json"
+    binary = False
+
+    def dumps(self, data: Any) -> str:
+        return ujson.dumps(stringify_ids(data))
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return ujson.loads(data)
+
+    def dispatch_head(self, event_name: str, payload: Any) -> str:
+        return f'{{"op":{GatewayOps.dispatch},"t":"{event_name}","d":{ujson.dumps(stringify_ids(payload))},"s":'
+
+    def dispatch_tail(self, s: int) -> str:
+        return f"{s}}}"
+
+class ETFEncoding(Encoding):
+    # ids are left as ints here, etf has proper 64 bit integers so clients using it get them as numbers like on discord
+    name = "etf"
+    binary = True
+
+    version = 131
+
+    new_float_ext = 70
+    small_integer_ext = 97
+    integer_ext = 98
+    float_ext = 99
+    atom_ext = 100
+    small_tuple_ext = 104
+    large_tuple_ext = 105
+    nil_ext = 106
+    string_ext = 107
+    list_ext = 108
+    binary_ext = 109
+    small_big_ext = 110
+    large_big_ext = 111
+    small_atom_ext = 115
+    map_ext = 116
+    atom_utf8_ext = 118
+    small_atom_utf8_ext = 119
+
+    atoms: dict[str, Any] = {"nil": None, "true": True, "false": False}
+
+    def dumps(self, data: Any) -> bytes:
+        buf = bytearray((self.version,))
+        self._encode(data, buf)
+        return bytes(buf)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            data = data.encode()
+
+        if data[0] != self.version:
+            raise ValueError("Invalid etf version")
+
+        value, _ = self._decode(data, 1)
+        return value
+
+    def dispatch_head(self, event_name: str, payload: Any) -> bytes:
+        buf = bytearray((self.version, self.map_ext))
+        buf += struct.pack(">I", 4)
+
+        for key, value in (("op", GatewayOps.dispatch), ("t", event_name), ("d", payload)):
+            self._encode_atom(key, buf)
+            self._encode(value, buf)
+
+        self._encode_atom("s", buf)
+        return bytes(buf)
+
+    def dispatch_tail(self, s: int) -> bytes:
+        buf = bytearray()
+        self._encode(s, buf)
+        return bytes(buf)
+
+    def _encode_atom(self, value: str, buf: bytearray):
+        encoded = value.encode()
+        buf.append(self.small_atom_utf8_ext)
+        buf.append(len(encoded))
+        buf += encoded
+
+    def _encode(self, data: Any, buf: bytearray):
+        if data is None:
+            self._encode_atom("nil", buf)
+
+        elif data is True:
+            self._encode_atom("true", buf)
+
+        elif data is False:
+            self._encode_atom("false", buf)
+
+        elif isinstance(data, int):
+            if 0 <= data <= 255:
+                buf.append(self.small_integer_ext)
+                buf.append(data)
+            elif -2 ** 31 <= data < 2 ** 31:
+                buf.append(self.integer_ext)
+                buf += struct.pack(">i", data)
+            else:
+                digits = abs(data).to_bytes((abs(data).bit_length() + 7) // 8, "little")
+                if len(digits) < 256:
+                    buf.append(self.small_big_ext)
+                    buf.append(len(digits))
+                else:
+                    buf.append(self.large_big_ext)
+                    buf += struct.pack(">I", len(digits))
+                buf.append(data < 0)
+                buf += digits
+
+        elif isinstance(data, float):
+            buf.append(self.new_float_ext)
+            buf += struct.pack(">d", data)
+
+        elif isinstance(data, (str, bytes)):
+            if isinstance(data, str):
+                data = data.encode()
+            buf.append(self.binary_ext)
+            buf += struct.pack(">I", len(data))
+            buf += data
+
+        elif isinstance(data, dict):
+            buf.append(self.map_ext)
+            buf += struct.pack(">I", len(data))
+            for key, value in data.items():
+                if isinstance(key, str) and len(key.encode()) < 256:
+                    self._encode_atom(key, buf)
+                else:
+                    self._encode(key, buf)
+                self._encode(value, buf)
+
+        elif isinstance(data, (list, tuple)):
+            if data:
+                buf.append(self.list_ext)
+                buf += struct.pack(">I", len(data))
+                for item in data:
+                    self._encode(item, buf)
+            buf.append(self.nil_ext)
+
+        elif isinstance(data, datetime.datetime):
+            self._encode(data.isoformat(), buf)
+
+        else:
+            raise TypeError(f"Cannot encode {type(data).__name__} as etf")
+
+    def _decode_atom(self, name: bytes) -> Any:
+        atom = name.decode()
+        return self.atoms.get(atom, atom)
+
+    def _decode(self, data: bytes, offset: int) -> tuple[Any, int]:
+        tag = data[offset]
+        offset += 1
+
+        if tag == self.small_integer_ext:
+            return data[offset], offset + 1
+
+        elif tag == self.integer_ext:
+            return struct.unpack_from(">i", data, offset)[0], offset + 4
+
+        elif tag == self.new_float_ext:
+            return struct.unpack_from(">d", data, offset)[0], offset + 8
+
+        elif tag == self.float_ext:
+            return float(data[offset:offset + 31].rstrip(b"\x00")), offset + 31
+
+        elif tag in (self.atom_ext, self.atom_utf8_ext):
+            length = struct.unpack_from(">H", data, offset)[0]
+            offset += 2
+            return self._decode_atom(data[offset:offset + length]), offset + length
+
+        elif tag in (self.small_atom_ext, self.small_atom_utf8_ext):
+            length = data[offset]
+            offset += 1
+            return self._decode_atom(data[offset:offset + length]), offset + length
+
+        elif tag == self.binary_ext:
+            length = struct.unpack_from(">I", data, offset)[0]
+            offset += 4
+            return data[offset:offset + length].decode(), offset + length
+
+        elif tag == self.string_ext:  # erlang strings are just lists of bytes
+            length = struct.unpack_from(">H", data, offset)[0]
+            offset += 2
+            return list(data[offset:offset + length]), offset + length
+
+        elif tag == self.nil_ext:
+            return [], offset
+
+        elif tag in (self.list_ext, self.small_tuple_ext, self.large_tuple_ext):
+            if tag == self.small_tuple_ext:
+                length = data[offset]
+                offset += 1
+            else:
+                length = struct.unpack_from(">I", data, offset)[0]
+                offset += 4
+
+            items = []
+            for _ in range(length):
+                item, offset = self._decode(data, offset)
+                items.append(item)
+
+            if tag == self.list_ext:
+                _, offset = self._decode(data, offset)  # the tail, always nil for proper lists
+
+            return items, offset
+
+        elif tag == self.map_ext:
+            length = struct.unpack_from(">I", data, offset)[0]
+            offset += 4
+
+            items = {}
+            for _ in range(length):
+                key, offset = self._decode(data, offset)
+                value, offset = self._decode(data, offset)
+                items[key] = value
+
+            return items, offset
+
+        elif tag in (self.small_big_ext, self.large_big_ext):
+            if tag == self.small_big_ext:
+                length = data[offset]
+                offset += 1
+            else:
+                length = struct.unpack_from(">I", data, offset)[0]
+                offset += 4
+
+            sign = data[offset]
+            offset += 1
+            value = int.from_bytes(data[offset:offset + length], "little")
+            return -value if sign else value, offset + length
+
+        raise ValueError(f"Unsupported etf tag {tag}")
+
+def _msgpack_default(data: Any) -> Any:
+    if isinstance(data, datetime.datetime):
+        return data.isoformat()
+
+    raise TypeError(f"Cannot encode {type(data).__name__} as msgpack")
+
+class MsgpackEncoding(Encoding):
+    name = "msgpack"
+    binary = True
+
+    def dumps(self, data: Any) -> bytes:
+        return msgpack.packb(stringify_ids(data), use_bin_type=True, default=_msgpack_default)  # type: ignore
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return msgpack.unpackb(data, raw=False)  # type: ignore
+
+    def dispatch_head(self, event_name: str, payload: Any) -> bytes:
+        head = b"\x84"  # fixmap with 4 items
+        for key, value in (("op", GatewayOps.dispatch), ("t", event_name), ("d", payload)):
+            head += self.dumps(key) + self.dumps(value)
+
+        return head + self.dumps("s")
+
+    def dispatch_tail(self, s: int) -> bytes:
+        return self.dumps(s)
+
+json_encoding = JSONEncoding()
+
+encodings: dict[str, Encoding] = {
+    "json": json_encoding,
+    "etf": ETFEncoding()
+}
+
+if msgpack is not None:
+    encodings["msgpack"] = MsgpackEncoding()
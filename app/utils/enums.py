@@ -58,5 +58,26 @@ class GatewayErrors:
     invalid_intents: int = 4013  # probably not going to be used
     disallowed_intent: int = 4014  # probably not going to be used
 
+class GatewayIntents:
+    guilds: int = 1 << 0
+    guild_members: int = 1 << 1
+    guild_bans: int = 1 << 2
+    guild_emojis: int = 1 << 3
+    guild_integrations: int = 1 << 4
+    guild_webhooks: int = 1 << 5
+    guild_invites: int = 1 << 6
+    guild_voice_states: int = 1 << 7
+    guild_presences: int = 1 << 8
+    guild_messages: int = 1 << 9
+    guild_message_reactions: int = 1 << 10
+    guild_message_typing: int = 1 << 11
+    direct_messages: int = 1 << 12
+    direct_message_reactions: int = 1 << 13
+    direct_message_typing: int = 1 << 14
+
+    @staticmethod
+    def all() -> int:
+        return 0b111111111111111
+
 class MessageTypes:
     default = 0
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+from typing import Any, Optional, Union
+
+from .encoding import Encoding, json_encoding
+from .enums import GatewayIntents
+
+# event name -> the intent a connection needs to receive it, anything not in here is always sent
+
+guild_event_intents: dict[str, int] = {
+    "GUILD_CREATE": GatewayIntents.guilds,
+    "GUILD_UPDATE": GatewayIntents.guilds,
+    "GUILD_DELETE": GatewayIntents.guilds,
+    "GUILD_ROLE_CREATE": GatewayIntents.guilds,
+    "GUILD_ROLE_UPDATE": GatewayIntents.guilds,
+    "GUILD_ROLE_DELETE": GatewayIntents.guilds,
+    "CHANNEL_CREATE": GatewayIntents.guilds,
+    "CHANNEL_UPDATE": GatewayIntents.guilds,
+    "CHANNEL_DELETE": GatewayIntents.guilds,
+    "CHANNEL_PINS_UPDATE": GatewayIntents.guilds,
+    "THREAD_CREATE": GatewayIntents.guilds,
+    "THREAD_UPDATE": GatewayIntents.guilds,
+    "THREAD_DELETE": GatewayIntents.guilds,
+    "GUILD_MEMBER_ADD": GatewayIntents.guild_members,
+    "GUILD_MEMBER_UPDATE": GatewayIntents.guild_members,
+    "GUILD_MEMBER_REMOVE": GatewayIntents.guild_members,
+    "GUILD_BAN_ADD": GatewayIntents.guild_bans,
+    "GUILD_BAN_REMOVE": GatewayIntents.guild_bans,
+    "GUILD_EMOJIS_UPDATE": GatewayIntents.guild_emojis,
+    "GUILD_INTEGRATIONS_UPDATE": GatewayIntents.guild_integrations,
+    "WEBHOOKS_UPDATE": GatewayIntents.guild_webhooks,
+    "INVITE_CREATE": GatewayIntents.guild_invites,
+    "INVITE_DELETE": GatewayIntents.guild_invites,
+    "VOICE_STATE_UPDATE": GatewayIntents.guild_voice_states,
+    "PRESENCE_UPDATE": GatewayIntents.guild_presences,
+    "MESSAGE_CREATE": GatewayIntents.guild_messages,
+    "MESSAGE_UPDATE": GatewayIntents.guild_messages,
+    "MESSAGE_DELETE": GatewayIntents.guild_messages,
+    "MESSAGE_DELETE_BULK": GatewayIntents.guild_messages,
+    "MESSAGE_REACTION_ADD": GatewayIntents.guild_message_reactions,
+    "MESSAGE_REACTION_REMOVE": GatewayIntents.guild_message_reactions,
+    "MESSAGE_REACTION_REMOVE_ALL": GatewayIntents.guild_message_reactions,
+    "MESSAGE_REACTION_REMOVE_EMOJI": GatewayIntents.guild_message_reactions,
+    "TYPING_START": GatewayIntents.guild_message_typing
+}
+
+dm_event_intents: dict[str, int] = {
+    "CHANNEL_PINS_UPDATE": GatewayIntents.direct_messages,
+    "MESSAGE_CREATE": GatewayIntents.direct_messages,
+    "MESSAGE_UPDATE": GatewayIntents.direct_messages,
+    "MESSAGE_DELETE": GatewayIntents.direct_messages,
+    "MESSAGE_REACTION_ADD": GatewayIntents.direct_message_reactions,
+    "MESSAGE_REACTION_REMOVE": GatewayIntents.direct_message_reactions,
+    "MESSAGE_REACTION_REMOVE_ALL": GatewayIntents.direct_message_reactions,
+    "MESSAGE_REACTION_REMOVE_EMOJI": GatewayIntents.direct_message_reactions,
+    "TYPING_START": GatewayIntents.direct_message_typing
+}
+
+class DispatchEvent:
+    __slots__ = ("name", "payload", "intent", "_heads")
+
+    def __init__(self, name: str, payload: Any, guild_id: Optional[int] = None):
+        self.name = name.upper()
+        self.payload = payload
+        self.intent = (guild_event_intents if guild_id is not None else dm_event_intents).get(self.name, 0)
+        self._heads: dict[str, Union[str, bytes]] = {}  # encoding name -> encoded frame without the sequence number
+
+    def encode(self, encoding: Encoding = json_encoding) -> Union[str, bytes]:
+        # the body is only encoded once per encoding no matter how many connections the event is fanned out to
+        head = self._heads.get(encoding.name)
+        if head is None:
+            head = self._heads[encoding.name] = encoding.dispatch_head(self.name, self.payload)
+
+        return head
+
+    def frame(self, s: int, encoding: Encoding = json_encoding) -> Union[str, bytes]:
+        return self.encode(encoding) + encoding.dispatch_tail(s)  # type: ignore
+
+    def __repr__(self) -> str:
+        return f"<DispatchEvent {self.name=}>"
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import logging
+import math
+import time
+from tornado.ioloop import PeriodicCallback
+from typing import Optional, Protocol
+
+from .enums import GatewayErrors
+
+class Heartbeating(Protocol):
+    heartbeat_deadline: float
+
+    def close(self, code: Optional[int] = None, reason: Optional[str] = None) -> None:
+        ...
+
+class HeartbeatSupervisor:
+    # a hashed timer wheel, connections live in the slot for the tick their deadline falls in
+    # and every tick only the slots that have fully passed get checked, instead of every connection having its own timer
+
+    def __init__(self, timeout: float, tick: float = 1.0):
+        self.timeout = timeout
+        self.tick_interval = tick
+        self.size = math.ceil(timeout / tick) + 2  # big enough that a deadline can never wrap around onto a slot that hasnt been checked yet
+        self.wheel: list[set[Heartbeating]] = [set() for _ in range(self.size)]
+        self.cursor = self._tick_of(time.monotonic()) - 1  # the last tick that was checked
+        self.expired = 0
+        self.callback: Optional[PeriodicCallback] = None
+
+    def _tick_of(self, deadline: float) -> int:
+        return int(deadline / self.tick_interval)
+
+    def _slot(self, deadline: float) -> set[Heartbeating]:
+        return self.wheel[self._tick_of(deadline) % self.size]
+
+    def start(self):
+        self.callback = PeriodicCallback(self.check, self.tick_interval * 1000)
+        self.callback.start()
+
+    def add(self, connection: Heartbeating):
+        connection.heartbeat_deadline = time.monotonic() + self.timeout
+        self._slot(connection.heartbeat_deadline).add(connection)
+
+    def touch(self, connection: Heartbeating):
+        self._slot(connection.heartbeat_deadline).discard(connection)
+        self.add(connection)
+
+    def remove(self, connection: Heartbeating):
+        self._slot(connection.heartbeat_deadline).discard(connection)
+
+    def check(self):
+        now = time.monotonic()
+        current = self._tick_of(now)
+        expired: list[Heartbeating] = []
+
+        while self.cursor < current - 1:
+            self.cursor += 1
+            expired.extend(connection for connection in self.wheel[self.cursor % self.size] if connection.heartbeat_deadline <= now)
+
+        for connection in expired:
+            self.remove(connection)
+            self.expire(connection)
+
+        if expired:
+            logging.info("Closed %s gateway connections that stopped heartbeating", len(expired))
+
+    def expire(self, connection: Heartbeating):
+        self.expired += 1
+        connection.close(GatewayErrors.session_timed_out, "Heartbeat timed out")
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+from typing import Any, AsyncIterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .database import DB
+
+class SessionStartLimit:
+    __slots__ = ("total", "remaining", "reset_at")
+
+    def __init__(self, total: int, remaining: int, reset_after: float):
+        self.total = total
+        self.remaining = remaining
+        self.reset_at = time.time() + reset_after
+
+    def get_reset_after(self) -> float:
+        return max(self.reset_at - time.time(), 0.0)
+
+class IdentifyQueue:
+    # identifies are the most expensive thing the gateway does, so they get let in gradually instead of all at once:
+    # each user gets max_concurrency buckets (shard_id % max_concurrency) that let one identify through per interval,
+    # at most `concurrency` identifies are building their ready at any one time, and each user has a daily budget of sessions.
+    # the buckets and budgets live in the database so every worker shares them, the concurrency is per worker since its about our own cpu
+
+    def __init__(self, database: DB, concurrency: int, max_concurrency: int, interval: float, session_limit: int, reset_after: float = 86400):
+        self.database = database
+        self.max_concurrency = max_concurrency
+        self.interval = interval
+        self.session_limit = session_limit
+        self.reset_after = reset_after
+
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        self.waiting = 0
+        self.active = 0
+
+    async def get_limit(self, user_id: int) -> SessionStartLimit:
+        async with self.database.accqire(readonly=True) as conn:
+            row = await self.database.queries.fetchrow(conn, "get_session_start_limit", user_id)
+
+        if row is None:
+            return SessionStartLimit(self.session_limit, self.session_limit, self.reset_after)  # nothing used today
+
+        return SessionStartLimit(self.session_limit, row["remaining"], row["reset_after"])
+
+    async def consume(self, user_id: int) -> bool:
+        async with self.database.accqire() as conn:
+            remaining = await self.database.queries.fetchval(conn, "consume_session_start", user_id, self.session_limit, self.reset_after)
+
+        return remaining is not None and remaining >= 0  # nothing comes back once the budget is used up
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user_id: int, shard_id: int) -> AsyncIterator[None]:
+        self.waiting += 1
+        try:
+            async with self.database.accqire() as conn:
+                # claims the next slot in the bucket and says how long until it comes up
+                wait = await self.database.queries.fetchval(conn, "claim_identify_bucket", user_id, shard_id % self.max_concurrency, self.interval)
+
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+    @classmethod
+    def from_config(cls, database: DB, config: dict[str, Any]) -> IdentifyQueue:
+        return cls(
+            database,
+            config.get("identify_concurrency", 16),
+            config.get("max_concurrency", 1),
+            config.get("identify_interval", 5),
+            config.get("session_start_limit", 1000)
+        )
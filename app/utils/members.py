@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import bisect
+import sys
+from typing import Any, Iterable, Iterator, Optional
+
+class MemberIndex:
+    # sorted (name, userid) pairs for one guild, so a prefix search is a bisect and a short scan instead of going over every member
+
+    __slots__ = ("entries", "names")
+
+    def __init__(self):
+        self.entries: list[tuple[str, int]] = []
+        self.names: dict[int, tuple[str, ...]] = {}  # userid -> the names they are indexed under
+
+    @staticmethod
+    def _normalize(names: Iterable[Optional[str]]) -> tuple[str, ...]:
+        return tuple({name.lower() for name in names if name})
+
+    def add(self, user_id: int, names: Iterable[Optional[str]]):
+        self.remove(user_id)
+
+        normalized = self.names[user_id] = self._normalize(names)
+        for name in normalized:
+            bisect.insort(self.entries, (name, user_id))
+
+    def extend(self, members: Iterable[tuple[int, Iterable[Optional[str]]]]):
+        # bulk load, sorts once at the end instead of inserting one at a time
+        for user_id, names in members:
+            if user_id in self.names:
+                self.remove(user_id)
+
+            normalized = self.names[user_id] = self._normalize(names)
+            self.entries.extend((name, user_id) for name in normalized)
+
+        self.entries.sort()
+
+    def remove(self, user_id: int):
+        for name in self.names.pop(user_id, ()):
+            i = bisect.bisect_left(self.entries, (name, user_id))
+            if i < len(self.entries) and self.entries[i] == (name, user_id):
+                del self.entries[i]
+
+    def search(self, query: str, limit: int) -> list[int]:
+        query = query.lower()
+        results: dict[int, None] = {}  # keeps the order while skipping people who match on both their username and nick
+
+        i = bisect.bisect_left(self.entries, (query,))
+        while i < len(self.entries) and len(results) < limit:
+            name, user_id = self.entries[i]
+            if not name.startswith(query):
+                break
+
+            results[user_id] = None
+            i += 1
+
+        return list(results)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+# the member and user caches hold one small slotted record per member and one per user shared between all their guilds,
+# keyed by snowflakes. they are read like the dicts they replaced, records get turned into dicts when they are looked up
+
+no_roles: tuple[Any, ...] = ()
+
+class User:
+    __slots__ = ("id", "username", "discriminator", "avatar")
+
+    def __init__(self, id: int, username: str, discriminator: str, avatar: Optional[str]):
+        self.id = id
+        self.username = sys.intern(username)
+        self.discriminator = sys.intern(discriminator)
+        self.avatar = avatar
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"username": self.username, "discriminator": self.discriminator, "id": self.id, "avatar": self.avatar}
+
+class Member:
+    __slots__ = ("user", "nick", "mute", "deaf", "joined_at", "roles")
+
+    def __init__(self, user: User, nick: Optional[str], mute: bool, deaf: bool, joined_at: Any, roles: tuple[Any, ...]):
+        self.user = user
+        self.nick = nick
+        self.mute = mute
+        self.deaf = deaf
+        self.joined_at = joined_at
+        self.roles = roles
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"id": self.user.id, "nick": self.nick, "mute": self.mute, "deaf": self.deaf, "joined_at": self.joined_at, "roles": list(self.roles)}
+
+class UserCache:
+    __slots__ = ("users",)
+
+    def __init__(self):
+        self.users: dict[int, User] = {}
+
+    def add(self, id: int, username: str, discriminator: str, avatar: Optional[str]) -> User:
+        # updates the existing record in place so every guild sees the change
+        user = self.users.get(id)
+
+        if user is None:
+            user = self.users[id] = User(id, username, discriminator, avatar)
+        else:
+            user.username = sys.intern(username)
+            user.discriminator = sys.intern(discriminator)
+            user.avatar = avatar
+
+        return user
+
+    def set(self, user: dict[str, Any]) -> User:
+        return self.add(user["id"], user["username"], user["discriminator"], user.get("avatar"))
+
+    def get(self, user_id: int, default: Optional[dict[str, Any]] = None) -> Optional[dict[str, Any]]:
+        user = self.users.get(user_id)
+        return user.to_dict() if user is not None else default
+
+    def pop(self, user_id: int, default: Optional[dict[str, Any]] = None) -> Optional[dict[str, Any]]:
+        user = self.users.pop(user_id, None)
+        return user.to_dict() if user is not None else default
+
+    def __getitem__(self, user_id: int) -> dict[str, Any]:
+        return self.users[user_id].to_dict()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.users
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+class GuildMembers:
+    __slots__ = ("members",)
+
+    def __init__(self):
+        self.members: dict[int, Member] = {}
+
+    def add(self, user: User, nick: Optional[str], mute: bool, deaf: bool, joined_at: Any, roles: Iterable[Any] = no_roles) -> Member:
+        member = self.members[user.id] = Member(user, nick, mute, deaf, joined_at, tuple(roles) or no_roles)
+        return member
+
+    def get(self, user_id: int, default: Optional[dict[str, Any]] = None) -> Optional[dict[str, Any]]:
+        member = self.members.get(user_id)
+        return member.to_dict() if member is not None else default
+
+    def pop(self, user_id: int, default: Optional[dict[str, Any]] = None) -> Optional[dict[str, Any]]:
+        member = self.members.pop(user_id, None)
+        return member.to_dict() if member is not None else default
+
+    def values(self) -> Iterator[dict[str, Any]]:
+        return (member.to_dict() for member in self.members.values())
+
+    def __getitem__(self, user_id: int) -> dict[str, Any]:
+        return self.members[user_id].to_dict()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.members
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.members)
+
+    def __len__(self) -> int:
+        return len(self.members)
@@ -10,3 +10,6 @@ def filter_channel_keys(channel: dict[str, Any]) -> dict[str, Any]:
     type: int = channel["type"]
     keys: list[str] = channel_keys[type]
     return {k: v for k, v in channel.items() if k in keys}
+
+def get_shard_id(guild_id: int, num_shards: int) -> int:
+    return (guild_id >> 22) % num_shards
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import asyncpg
+import datetime
+import os
+from typing import Iterator, Union
+
+Connection = Union[asyncpg.Connection, "asyncpg.pool.PoolConnectionProxy"]
+
+# messages are range partitioned by month on id, snowflakes start with a timestamp so a month of messages is a range of ids.
+# new messages only ever land in the newest partition which keeps its indexes and vacuums small,
+# and old months can be detached or archived without touching anything else
+
+def snowflake_at(when: datetime.datetime, epoch: int) -> int:
+    return (int(when.timestamp() * 1000) - epoch) << 22
+
+def month_of(when: datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(when.year, when.month, 1, tzinfo=datetime.timezone.utc)
+
+def next_month(month: datetime.datetime) -> datetime.datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+def iter_months(start: datetime.datetime, count: int) -> Iterator[datetime.datetime]:
+    month = month_of(start)
+    for _ in range(count):
+        yield month
+        month = next_month(month)
+
+def partition_name(month: datetime.datetime) -> str:
+    return f"messages_{month.year}_{month.month:02}"
+
+def partition_month(name: str) -> datetime.datetime:
+    _, year, month = name.split("_")
+    return datetime.datetime(int(year), int(month), 1, tzinfo=datetime.timezone.utc)
+
+async def get_partitions(conn: Connection) -> list[str]:
+    rows = await conn.fetch("""select child.relname from pg_inherits
+                               inner join pg_class parent on parent.oid=pg_inherits.inhparent
+                               inner join pg_class child on child.oid=pg_inherits.inhrelid
+                               where parent.relname='messages' and child.relname != 'messages_default' order by child.relname""")
+    return [row["relname"] for row in rows]
+
+async def create_partitions(conn: Connection, epoch: int, start: datetime.datetime, count: int) -> list[str]:
+    created: list[str] = []
+
+    for month in iter_months(start, count):
+        name = partition_name(month)
+
+        try:
+            async with conn.transaction():  # a savepoint so an existing partition doesnt abort whatever transaction we are in
+                await conn.execute(f"create table {name} partition of messages for values from ({snowflake_at(month, epoch)}) to ({snowflake_at(next_month(month), epoch)})")
+        except asyncpg.DuplicateTableError:
+            continue  # already there, or another worker just made it
+
+        created.append(name)
+
+    return created
+
+async def detach_partitions(conn: Connection, before: datetime.datetime, schema: str = "archive") -> list[str]:
+    # detached months are moved into another schema, they can still be queried there or dropped whenever
+    detached: list[str] = []
+    await conn.execute(f"create schema if not exists {schema}")
+
+    for name in await get_partitions(conn):
+        if next_month(partition_month(name)) > before:
+            continue
+
+        await conn.execute(f"alter table messages detach partition {name}")
+        await conn.execute(f"alter table {name} set schema {schema}")
+        detached.append(name)
+
+    return detached
+
+async def archive_partitions(conn: Connection, schema: str, output: str) -> list[str]:
+    # copies detached months out to binary copy files and drops them, load one back with copy ... from ... (format binary)
+    archived: list[str] = []
+    rows = await conn.fetch("select tablename from pg_tables where schemaname=$1 and tablename like 'messages\\_%' order by tablename", schema)
+
+    for row in rows:
+        name = row["tablename"]
+        path = os.path.join(output, f"{name}.copy")
+
+        await conn.copy_from_table(name, schema_name=schema, output=path, format="binary")
+        await conn.execute(f"drop table {schema}.{name}")
+        archived.append(path)
+
+    return archived
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Callable, Iterable, Optional
+
+PresenceCallback = Callable[[int, dict[str, Any]], None]
+
+offline: dict[str, Any] = {"status": "offline", "activities": []}
+
+class PresenceStore:
+    # updates are held for a short window and only the latest one per user gets sent,
+    # so someone flapping between statuses turns into a single presence_update (or none if they end up back where they started)
+
+    def __init__(self, window: float, callback: PresenceCallback):
+        self.window = window
+        self.callback = callback
+
+        self.presences: dict[int, dict[str, Any]] = {}  # userid -> presence, offline users arent stored
+        self.pending: dict[int, dict[str, Any]] = {}  # userid -> latest presence waiting to be sent
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def get(self, user_id: int) -> dict[str, Any]:
+        return self.presences.get(user_id, offline)
+
+    def for_users(self, user_ids: Iterable[int]) -> list[dict[str, Any]]:
+        return [{"user": {"id": user_id}} | presence for user_id in user_ids if (presence := self.presences.get(user_id)) is not None]
+
+    def set(self, user_id: int, presence: dict[str, Any]):
+        if presence["status"] == "offline":
+            self.presences.pop(user_id, None)
+        else:
+            self.presences[user_id] = presence
+
+    def update(self, user_id: int, presence: dict[str, Any]):
+        self.pending[user_id] = presence
+
+        if self._handle is None:
+            self._handle = asyncio.get_event_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        self._handle = None
+
+        for user_id, presence in pending.items():
+            if presence != self.get(user_id):
+                self.callback(user_id, presence)
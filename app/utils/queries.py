@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import asyncpg
+import logging
+from asyncpg.prepared_stmt import PreparedStatement
+import time
+from typing import Any, Literal, Optional, Union, get_args
+
+Connection = Union[asyncpg.Connection, "asyncpg.pool.PoolConnectionProxy"]
+QueryName = Literal[  # so a misspelt query name is a type error instead of a KeyError at runtime
+    "get_user", "get_user_by_email", "get_discriminators", "create_user", "get_user_settings", "create_user_settings",
+    "get_guild", "get_partial_guilds", "get_member_guild", "create_guild", "delete_guild", "get_guilds_roles",
+    "is_member", "get_user_guild_ids", "count_user_guilds", "create_member", "join_guild", "get_member_roles", "get_guilds_member_roles",
+    "get_guilds_members", "get_guilds_member_state", "get_members_after", "get_members_by_id",
+    "get_channel", "get_guild_channels", "get_guilds_channels", "get_guilds_channel_ids", "create_channel", "delete_channel",
+    "get_invite", "create_invite", "delete_invite",
+    "create_message", "get_messages", "get_messages_before", "get_messages_after", "get_messages_around",
+    "consume_session_start", "get_session_start_limit", "claim_identify_bucket",
+]
+
+# every query the app runs per request, by name. each pool connection prepares all of them once when its opened
+# so they are never parsed or planned again, startup only queries that run once stay inline
+queries: dict[str, str] = {
+    # users
+    "get_user": "select username, discriminator, id, avatar from users where id=$1",
+    "get_user_by_email": "select * from users where email=$1",
+    "get_discriminators": "select discriminator from users where username=$1",
+    "create_user": "insert into users(id, username, hashed_password, email, discriminator) values($1, $2, $3, $4, $5)",
+    "get_user_settings": "select locale, theme from user_settings where user_id=$1",
+    "create_user_settings": "insert into user_settings(user_id) values ($1) returning theme, locale",
+
+    # guilds
+    "get_guild": "select * from guilds where id=$1",
+    "get_partial_guilds": "select id, name, splash, banner, description, icon, features, verification_level, vanity_url_code, nsfw from guilds where id = any($1::bigint[])",
+    "get_member_guild": "select * from guilds where id=$1 and exists (select 1 from guild_members where guild_id=$1 and user_id=$2)",
+    "create_guild": """insert into guilds(name, id, owner_id, verification_level, default_message_notifications, explicit_content_filter)
+                       values($1, $2, $3, $4, $5, $6) returning *""",
+    "delete_guild": "delete from guilds where id=$1 and owner_id=$2",
+    "get_guilds_roles": "select id, name, color, hoist, position, permissions, managed, mentionable, guild_id from guild_roles where guild_id = any($1::bigint[])",
+
+    # members
+    "is_member": "select 1 from guild_members where guild_id=$1 and user_id=$2",
+    "get_user_guild_ids": "select guild_id from guild_members where user_id=$1",
+    "count_user_guilds": "select count(*) from guild_members where user_id=$1",
+    "create_member": "insert into guild_members(user_id, guild_id, joined_at) values ($1, $2, $3) returning *",
+    "join_guild": "insert into guild_members(user_id, guild_id, joined_at) values($1, $2, $3) returning nick, joined_at, deaf, mute",
+    "get_member_roles": """select id, name, color, hoist, position, permissions, managed, mentionable from guild_roles
+                           inner join member_roles on member_roles.role_id=guild_roles.id where member_roles.user_id=$1 and member_roles.guild_id=$2""",
+    "get_guilds_member_roles": """select member_roles.guild_id, member_roles.user_id, id, name, color, hoist, position, permissions, managed, mentionable from guild_roles
+                                  inner join member_roles on member_roles.role_id=guild_roles.id where member_roles.guild_id = any($1::bigint[])""",
+    "get_guilds_members": """select guild_members.guild_id, user_id, joined_at, deaf, mute, pending, nick, username, discriminator, avatar from guild_members
+                             inner join users on guild_members.user_id=users.id where guild_members.guild_id = any($1::bigint[])""",
+    "get_guilds_member_state": """select user_id, guild_members.guild_id, joined_at, deaf, mute, nick, username, discriminator, avatar from guild_members
+                                  inner join users on guild_members.user_id=users.id where guild_members.guild_id = any($1::bigint[])""",
+    **{f"get_members_{name}": f"""select guild_members.user_id, joined_at, deaf, mute, pending, nick, username, discriminator, avatar, coalesce((
+                                      select json_agg(json_build_object('id', id, 'name', name, 'color', color, 'hoist', hoist, 'position', position,
+                                                                        'permissions', permissions, 'managed', managed, 'mentionable', mentionable))
+                                      from member_roles inner join guild_roles on member_roles.role_id=guild_roles.id
+                                      where member_roles.guild_id=guild_members.guild_id and member_roles.user_id=guild_members.user_id
+                                  ), '[]'::json) as roles
+                                  from guild_members inner join users on guild_members.user_id=users.id
+                                  where guild_members.guild_id=$1 and {condition} order by guild_members.user_id asc limit $3"""
+       for name, condition in (("after", "guild_members.user_id > $2"), ("by_id", "guild_members.user_id = any($2::bigint[])"))},
+
+    # channels
+    "get_channel": "select * from guild_channels where id=$1",
+    "get_guild_channels": "select * from guild_channels where guild_id=$1",
+    "get_guilds_channels": "select * from guild_channels where guild_id = any($1::bigint[])",
+    "get_guilds_channel_ids": "select id, guild_id from guild_channels where guild_id = any($1::bigint[])",
+    "create_channel": "insert into guild_channels values($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11) returning *",
+    "delete_channel": "delete from guild_channels where id=$1 returning *",
+
+    # invites
+    "get_invite": "select channel_id, guild_id, inviter_id, expires_at from guild_invites where code=$1",
+    "create_invite": """insert into guild_invites(code, channel_id, max_uses, guild_id, expires_at, inviter_id, max_age, temporary, created_at)
+                        values($1, $2, $3, $4, $5, $6, $7, $8, $9)""",
+    "delete_invite": "delete from guild_invites where code=$1 returning channel_id, guild_id, inviter_id",
+
+    # messages
+    "create_message": "insert into messages(id, channel_id, content, tts, embeds, allowed_mentions) values ($1, $2, $3, $4, $5, $6)",
+    # ids sort by time since they start with a timestamp, these all use the (channel_id, id) index
+    "get_messages": "select * from messages where channel_id=$1 order by id desc limit $2",
+    "get_messages_before": "select * from messages where channel_id=$1 and id < $2 order by id desc limit $3",
+    "get_messages_after": "select * from messages where channel_id=$1 and id > $2 order by id asc limit $3",
+    "get_messages_around": """(select * from messages where channel_id=$1 and id >= $2 order by id asc limit $3)
+                              union all
+                              (select * from messages where channel_id=$1 and id < $2 order by id desc limit $4)""",
+
+    # identify limits, $1 is the user and $3 the reset or bucket interval in seconds
+    "consume_session_start": """insert into session_start_limits as limits (user_id, remaining, reset_at) values ($1, $2 - 1, now() + make_interval(secs => $3::float8))
+                                on conflict (user_id) do update set
+                                    remaining = case when limits.reset_at <= now() then excluded.remaining else limits.remaining - 1 end,
+                                    reset_at = case when limits.reset_at <= now() then excluded.reset_at else limits.reset_at end
+                                where limits.reset_at <= now() or limits.remaining > 0
+                                returning remaining""",
+    "get_session_start_limit": "select remaining, extract(epoch from reset_at - now())::float8 as reset_after from session_start_limits where user_id=$1 and reset_at > now()",
+    "claim_identify_bucket": """insert into identify_buckets as buckets (user_id, bucket, allowed_at) values ($1, $2, now() + make_interval(secs => $3::float8))
+                                on conflict (user_id, bucket) do update set allowed_at = greatest(buckets.allowed_at, now()) + make_interval(secs => $3::float8)
+                                returning extract(epoch from allowed_at - now())::float8 - $3::float8""",
+}
+
+assert set(get_args(QueryName)) == set(queries), "QueryName has to list exactly the queries above"
+
+# parameters that never get written to the slow query log, by query name and 1 based position
+redacted: dict[QueryName, tuple[int, ...]] = {
+    "get_user_by_email": (1,),
+    "create_user": (3, 4),
+    "create_message": (3, 5, 6),
+}
+
+def redact(name: QueryName, args: tuple[Any, ...]) -> list[Any]:
+    positions = redacted.get(name, ())
+    return ["<redacted>" if i in positions else (arg[:100] if isinstance(arg, str) else arg) for i, arg in enumerate(args, 1)]
+
+class QueryStats:
+    __slots__ = ("calls", "total", "max")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, elapsed: float):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+class QueryCatalog:
+    def __init__(self, queries: dict[str, str], slow_threshold: float = 0.1):
+        self.queries = queries
+        self.slow_threshold = slow_threshold  # seconds before a query gets logged
+        self.stats = {name: QueryStats() for name in queries}
+        self.statements: dict[asyncpg.Connection, dict[str, PreparedStatement]] = {}
+
+    async def prepare(self, connection: asyncpg.Connection):
+        # schema changes dont go through here, create table ... partition of messages takes a strong lock on messages and queues behind
+        # every open transaction on it, with everything that comes after queued behind that. App.create_message_partitions and the scripts
+        # use a connection of their own with a lock_timeout so they give up instead
+        self.statements = {conn: statements for conn, statements in self.statements.items() if not conn.is_closed()}
+
+        statements = self.statements[connection] = {}
+        for name, query in self.queries.items():
+            try:
+                statements[name] = await connection.prepare(query)
+            except asyncpg.PostgresError as e:
+                # it still gets run unprepared so the error shows up where its used instead of taking the whole pool down
+                logging.warning("Could not prepare query %s: %s", name, e)
+
+    def _statement(self, conn: Connection, name: QueryName) -> Optional[PreparedStatement]:
+        real = conn if isinstance(conn, asyncpg.Connection) else conn._con  # pool connections are proxies around the real connection
+        statements = self.statements.get(real) if real is not None else None  # a released proxy has no connection left
+        return (statements or {}).get(name)
+
+    async def _run(self, conn: Connection, name: QueryName, method: str, args: tuple[Any, ...]) -> Any:
+        statement = self._statement(conn, name)
+        start = time.perf_counter()
+
+        try:
+            if statement is None:
+                return await getattr(conn, method)(self.queries[name], *args)
+            elif method == "execute":
+                await statement.fetch(*args)
+                return statement.get_statusmsg()
+            else:
+                return await getattr(statement, method)(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stats[name].record(elapsed)
+
+            if elapsed > self.slow_threshold:
+                params = f"{len(args[0])} rows" if method == "executemany" else redact(name, args)
+                logging.warning("Slow query %s took %.1fms with %s", name, elapsed * 1000, params)
+
+    async def fetch(self, conn: Connection, name: QueryName, *args: Any) -> list[asyncpg.Record]:
+        return await self._run(conn, name, "fetch", args)
+
+    async def fetchrow(self, conn: Connection, name: QueryName, *args: Any) -> Optional[asyncpg.Record]:
+        return await self._run(conn, name, "fetchrow", args)
+
+    async def fetchval(self, conn: Connection, name: QueryName, *args: Any) -> Any:
+        return await self._run(conn, name, "fetchval", args)
+
+    async def execute(self, conn: Connection, name: QueryName, *args: Any) -> str:
+        return await self._run(conn, name, "execute", args)
+
+    async def executemany(self, conn: Connection, name: QueryName, args: list[tuple[Any, ...]]) -> None:
+        await self._run(conn, name, "executemany", (args,))
+
+    def cursor(self, conn: Connection, name: QueryName, *args: Any, prefetch: Optional[int] = None) -> Any:
+        # not timed since the rows get used as they come in, has to be iterated inside a transaction
+        statement = self._statement(conn, name)
+        if statement is None:
+            return conn.cursor(self.queries[name], *args, prefetch=prefetch)
+
+        return statement.cursor(*args, prefetch=prefetch)
+
+    def report(self, limit: int = 10) -> list[tuple[str, QueryStats]]:
+        # the queries that took up the most time overall
+        return sorted(((name, stats) for name, stats in self.stats.items() if stats.calls), key=lambda item: item[1].total, reverse=True)[:limit]
@@ -90,7 +90,7 @@ class RatelimitMapping:
     __slots__ = ("_cache", "_cooldown")
 
     def __init__(self, original: Ratelimit):
-        self._cache: dict[str, Ratelimit] = {}
+        self._cache: dict[int, Ratelimit] = {}
         self._cooldown = original
 
     def copy(self) -> RatelimitMapping:
@@ -115,7 +115,7 @@ class RatelimitMapping:
     def create_bucket(self):
         return self._cooldown.copy()
 
-    def get_bucket(self, user_id: str, current: Optional[float] = None) -> Ratelimit:
+    def get_bucket(self, user_id: int, current: Optional[float] = None) -> Ratelimit:
         self._verify_cache_integrity(current)
         if user_id not in self._cache:
             bucket = self._cooldown.copy()
@@ -125,7 +125,7 @@ class RatelimitMapping:
 
         return bucket
 
-    def update_ratelimit(self, user_id: str, current: Optional[float] = None) -> Optional[float]:
+    def update_ratelimit(self, user_id: int, current: Optional[float] = None) -> Optional[float]:
         bucket = self.get_bucket(user_id, current)
         return bucket.update_ratelimit(current)
 
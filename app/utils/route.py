@@ -10,6 +10,7 @@ import math
 from typing import Tuple, Optional, Callable, Awaitable, TYPE_CHECKING, Union, Dict, Any, TypeVar, overload
 
 from .enums import HTTPErrors
+from .snowflakes import stringify_ids
 
 if TYPE_CHECKING:
     from app.app import App
@@ -28,7 +29,7 @@ class RequestHandler(BaseRequestHandler):
     def initialize(self, database: DB, tokens: Tokens):
         self.database = database
         self.tokens = tokens
-        self.user_id: str = ""  # setting to an empty string instead of none makes my typing life easier
+        self.user_id: int = 0  # setting to 0 instead of none makes my typing life easier
 
         self.body: dict[str, Any]
 
@@ -63,6 +64,14 @@ class RequestHandler(BaseRequestHandler):
         self.set_header("X-RateLimit-Reset", round(bucket._window + bucket.per))
         self.set_header("X-RateLimit-Global", True)
 
+    def decode_argument(self, value: bytes, name: Optional[str] = None) -> Any:
+        # ids in the url are named groups that only match digits, handlers get them as ints
+        argument = super().decode_argument(value, name)
+        if name is not None and name.endswith("_id"):
+            return int(argument)
+
+        return argument
+
     def error(self, code: Tuple[int, str], status_code: int = 400, **kwargs: Any) -> None:
         return self.send_error(status_code, code=code[0], message=code[1], **kwargs)
 
@@ -82,7 +91,7 @@ class RequestHandler(BaseRequestHandler):
     def write(self, body: Union[str, bytes, dict, list]) -> None:
         if isinstance(body, (dict, list)):
             self.set_header("Content-Type", "application/json")
-            body = ujson.dumps(body)
+            body = ujson.dumps(stringify_ids(body))
         
         return super().write(body)
 
@@ -131,7 +140,7 @@ class WebSocketHandler(BaseWebSocketHandler):
         if self.ws_connection is None or self.ws_connection.is_closing():
             raise WebSocketClosedError()
         if isinstance(message, dict):
-            message = ujson.dumps(message)
+            message = ujson.dumps(stringify_ids(message))
         return await self.ws_connection.write_message(message, binary=binary)
 
     def initialize(self, database: DB, tokens: Tokens) -> None:
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import secrets
+from typing import Any, Optional
+
+from .events import DispatchEvent
+from .misc import get_shard_id
+
+class Session:
+    __slots__ = ("id", "user_id", "shard_id", "num_shards", "s", "intents", "guild_ids", "presence", "buffer", "_expiry")
+
+    def __init__(self, user_id: int, buffer_size: int, shard_id: int = 0, num_shards: int = 1):
+        self.id = secrets.token_hex(16)
+        self.user_id = user_id
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        self.s = 0
+        self.intents = 0
+        self.guild_ids: list[int] = []
+        self.presence: dict[str, Any] = {"status": "online"}
+        self.buffer = collections.deque[tuple[int, DispatchEvent]](maxlen=buffer_size)  # only the most recent events are kept
+        self._expiry: Optional[asyncio.TimerHandle] = None
+
+    def owns(self, guild_id: Optional[int]) -> bool:
+        if guild_id is None:
+            return self.shard_id == 0  # events that arent tied to a guild always go to the first shard
+
+        return get_shard_id(guild_id, self.num_shards) == self.shard_id
+
+    def accepts(self, event: DispatchEvent, guild_id: Optional[int]) -> bool:
+        if event.intent and not self.intents & event.intent:
+            return False  # they didnt ask for this event
+
+        return self.owns(guild_id)
+
+    def record(self, event: DispatchEvent) -> int:
+        self.s += 1
+        self.buffer.append((self.s, event))
+        return self.s
+
+    def replay(self, seq: int) -> Optional[list[tuple[int, DispatchEvent]]]:
+        if seq > self.s:
+            return None
+
+        if seq < self.s and (not self.buffer or self.buffer[0][0] > seq + 1):
+            return None  # some of the missed events have already fallen out of the buffer
+
+        return [item for item in self.buffer if item[0] > seq]
+
+    def __repr__(self) -> str:
+        return f"<Session {self.id=} {self.user_id=} {self.s=}>"
+
+class SessionStore:
+    def __init__(self, buffer_size: int, timeout: float):
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+
+        self.sessions: dict[str, Session] = {}  # sessionid -> session
+        self.detached: dict[int, list[Session]] = {}  # userid -> sessions waiting to be resumed
+
+    def create(self, user_id: int, shard_id: int = 0, num_shards: int = 1) -> Session:
+        session = Session(user_id, self.buffer_size, shard_id, num_shards)
+        self.sessions[session.id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self.sessions.get(session_id)
+
+    def attach(self, session: Session):
+        if session._expiry is not None:
+            session._expiry.cancel()
+            session._expiry = None
+
+        self._remove_detached(session)
+
+    def detach(self, session: Session):
+        self.detached.setdefault(session.user_id, []).append(session)
+        session._expiry = asyncio.get_event_loop().call_later(self.timeout, self.expire, session)
+
+    def expire(self, session: Session):
+        self.sessions.pop(session.id, None)
+        self._remove_detached(session)
+
+    def _remove_detached(self, session: Session):
+        sessions = self.detached.get(session.user_id)
+        if sessions is None or session not in sessions:
+            return
+
+        sessions.remove(session)
+        if not sessions:
+            del self.detached[session.user_id]
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> SessionStore:
+        return cls(config.get("resume_buffer_size", 1000), config.get("resume_timeout", 60))
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import datetime
+from typing import Any
+
+# ids are ints everywhere inside the app and in the database, they only become strings when they are sent to a client as json
+# (javascript cant hold a 64 bit int) and come back in as strings, so this is the only place that knows about that
+
+def snowflake(value: Any) -> int:
+    # ids from clients arent validated as numbers, those just dont match anything
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+def is_id_key(key: Any) -> bool:
+    return key == "id" or (isinstance(key, str) and key.endswith("_id"))
+
+def is_id_list_key(key: Any) -> bool:
+    return key == "roles" or (isinstance(key, str) and key.endswith("_ids"))
+
+def stringify_ids(data: Any) -> Any:
+    # a copy with every id as a string, everything else that happens to be an int (types, positions, colors) is left alone.
+    # datetimes become iso strings here too, ujson would send them as epoch seconds while etf and msgpack send iso
+    if isinstance(data, dict):
+        result = {}
+
+        for key, value in data.items():
+            if type(value) is int and is_id_key(key):
+                result[key] = str(value)
+            elif isinstance(value, list) and is_id_list_key(key):
+                result[key] = [str(item) if type(item) is int else stringify_ids(item) for item in value]
+            elif isinstance(value, (dict, list, datetime.datetime)):
+                result[key] = stringify_ids(value)
+            else:
+                result[key] = value
+
+        return result
+
+    if isinstance(data, (list, tuple)):
+        return [stringify_ids(item) for item in data]
+
+    if isinstance(data, datetime.datetime):
+        return data.isoformat()
+
+    return data
+
+def isoformat_datetimes(data: Any) -> Any:
+    # the same datetimes as stringify_ids but ids stay ints, for json that only goes between workers
+    if isinstance(data, dict):
+        return {key: isoformat_datetimes(value) if isinstance(value, (dict, list, datetime.datetime)) else value for key, value in data.items()}
+
+    if isinstance(data, (list, tuple)):
+        return [isoformat_datetimes(item) for item in data]
+
+    if isinstance(data, datetime.datetime):
+        return data.isoformat()
+
+    return data
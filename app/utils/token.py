@@ -18,11 +18,11 @@ class Tokens:
         self.inc = 0
         self.signer = itsdangerous.TimestampSigner(secret)
 
-    def create_token(self, id: str) -> str:
-        based_token = base64.b64encode(id.encode())
+    def create_token(self, id: int) -> str:
+        based_token = base64.b64encode(str(id).encode())
         return self.signer.sign(based_token).decode()
 
-    def create_id(self) -> str:
+    def create_id(self) -> int:
         self.inc += 1
         now = int(time.time() * 1000 - self.epoch)
 
@@ -31,14 +31,14 @@ class Tokens:
         snowflake |= (self.process_id) << 12
         snowflake |= self.inc
 
-        return str(snowflake)
+        return snowflake
 
-    def validate_token(self, token: str, *, max_age: Optional[int] = None) -> str:
+    def validate_token(self, token: str, *, max_age: Optional[int] = None) -> int:
         encoded_token = token.encode()
         data = self.signer.unsign(encoded_token, max_age=max_age)
 
         encoded_id = data.decode()
-        return base64.b64decode(encoded_id).decode()
+        return int(base64.b64decode(encoded_id))
 
     def generate_invite_code(self) -> str:
         chars = [secrets.choice(invite_chars) for _ in range(self.invite_length)]
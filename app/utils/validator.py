@@ -44,7 +44,7 @@ class Dict(_OptionalSpec, total=False):
 
 class Generic(_OptionalSpec, total=False):
     schema: _Spec
-    type: str
+    type: Union[str, list[str]]  # any of them
 
 # dict takes a differant schema that regular 
 
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import asyncio
+import asyncpg
+import logging
+from typing import Any, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .database import DB
+
+class MessageWriter:
+    # message inserts that come in within a few ms of each other are written with one executemany in one transaction
+    # instead of a connection and a commit each, every request still only gets its answer once the batch it was in has committed
+
+    def __init__(self, database: DB, window: float, max_batch: int):
+        self.database = database
+        self.window = window
+        self.max_batch = max_batch
+
+        self.pending: list[tuple[tuple[Any, ...], asyncio.Future[None]]] = []
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+        self.batches = 0
+        self.written = 0
+
+    async def insert(self, *args: Any):
+        if self.window <= 0:
+            async with self.database.accqire() as conn:
+                await self.database.queries.execute(conn, "create_message", *args)
+
+            return
+
+        loop = asyncio.get_event_loop()
+        future: asyncio.Future[None] = loop.create_future()
+        self.pending.append((args, future))
+
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self._handle is None:
+            self._handle = loop.call_later(self.window, self.flush)
+
+        await future
+
+    def flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.create_task(self.write(batch))
+
+    async def write(self, batch: list[tuple[tuple[Any, ...], asyncio.Future[None]]]):
+        try:
+            async with self.database.accqire() as conn:
+                await self.database.queries.executemany(conn, "create_message", [args for args, _ in batch])
+        except asyncpg.PostgresError as e:
+            # the whole batch got rolled back, go through it one at a time so only the bad messages fail
+            logging.debug("Message batch of %s failed (%s), retrying one at a time", len(batch), e)
+            for args, future in batch:
+                try:
+                    async with self.database.accqire() as conn:
+                        await self.database.queries.execute(conn, "create_message", *args)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    self.written += 1
+                    if not future.done():
+                        future.set_result(None)
+
+            return
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        self.batches += 1
+        self.written += len(batch)
+
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    @classmethod
+    def from_config(cls, database: DB, config: dict[str, Any]) -> MessageWriter:
+        return cls(database, config.get("write_batch_window", 0.002), config.get("write_batch_size", 100))
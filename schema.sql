@@ -6,7 +6,7 @@ create table users
 		constraint email
 			unique,
 	hashed_password text,
-	id text not null
+	id bigint not null
 		constraint users_pk
 			primary key
 		constraint users_id_unique
@@ -17,7 +17,7 @@ create table user_settings
 (
 	theme text default 'dark'::text not null,
 	locale text default 'en-GB'::text not null,
-	user_id text not null
+	user_id bigint not null
 		constraint user_settings_pk
 			primary key
 		constraint user_id
@@ -30,22 +30,22 @@ create table user_settings
 create table guilds
 (
 	name text not null,
-	owner_id text not null,
-	id text not null
+	owner_id bigint not null,
+	id bigint not null
 		constraint guilds_pkey
 			primary key,
 	icon text,
 	splash text,
-	afk_channel_id text,
+	afk_channel_id bigint,
 	afk_timeout integer default 300 not null,
 	verification_level integer default 0 not null,
 	default_message_notifications integer default 0 not null,
 	mfa_level integer default 0 not null,
 	explicit_content_filter integer default 0,
-	application_id text,
-	system_channel_id text,
+	application_id bigint,
+	system_channel_id bigint,
 	system_channel_flags integer default 0 not null,
-	rules_channel_id text,
+	rules_channel_id bigint,
 	large boolean default false,
 	unavailable boolean default false,
 	member_count integer default 1,
@@ -54,15 +54,15 @@ create table guilds
 	premium_tier integer default 3,
 	premium_subscription_count integer default 999,
 	preferred_locale text default 'en-US'::text,
-	public_updates_channel_id text,
+	public_updates_channel_id bigint,
 	nsfw boolean default false,
 	features text[] default ARRAY[]::text[] not null
 );
 
 create table guild_members
 (
-	user_id text not null,
-	guild_id text not null,
+	user_id bigint not null,
+	guild_id bigint not null,
 	joined_at timestamp with time zone default now() not null,
 	deaf boolean default false not null,
 	mute boolean default false not null,
@@ -74,7 +74,7 @@ create table guild_members
 
 create table guild_roles
 (
-	id text not null,
+	id bigint not null,
 	name text not null,
 	color integer default 16777215,
 	hoist boolean default false not null,
@@ -82,7 +82,7 @@ create table guild_roles
 	permissions text default 0 not null,
 	managed boolean default false,
 	mentionable boolean default false not null,
-	guild_id text not null
+	guild_id bigint not null
 		constraint guild_roles_pk
 			primary key
 		constraint guild_roles_guild_id_guilds
@@ -93,10 +93,22 @@ create table guild_roles
 create unique index guild_roles_id_uindex
 	on guild_roles (id);
 
+create table member_roles
+(
+	user_id bigint not null,
+	guild_id bigint not null,
+	role_id bigint not null
+		constraint member_roles_role_id_guild_roles
+			references guild_roles (id)
+				on delete cascade,
+	constraint member_roles_pk
+		primary key (guild_id, user_id, role_id)
+);
+
 create table guild_channels
 (
 	name text not null,
-	id text not null
+	id bigint not null
 		constraint guild_channels_pk
 			primary key,
 	type integer default 0 not null,
@@ -105,9 +117,9 @@ create table guild_channels
 	user_limit integer default 0 not null,
 	rate_limit_per_user integer default 0 not null,
 	position integer not null,
-	parent_id text,
+	parent_id bigint,
 	nsfw boolean default false not null,
-	guild_id text not null
+	guild_id bigint not null
 		constraint guild_channels_guild_id_guilds
 			references guilds
 				on delete cascade
@@ -116,20 +128,62 @@ create table guild_channels
 create unique index guild_channels_id_uindex
 	on guild_channels (id);
 
+create index guild_members_guild_id_index
+	on guild_members (guild_id, user_id);
+
+create index guild_channels_guild_id_index
+	on guild_channels (guild_id);
+
+create index guild_roles_guild_id_index
+	on guild_roles (guild_id);
+
+-- partitioned by month on the snowflake, the monthly partitions are made by the app on startup and by scripts/partitions
 create table messages
 (
-	id text not null
-		constraint messages_pk
-			primary key,
+	id bigint not null,
 	content text,
 	embeds json,
 	tts boolean default false not null,
 	allowed_mentions jsonb,
-	channel_id text
+	channel_id bigint
 		constraint messages_channel_id_guild_messages
 			references guild_channels
-				on delete cascade
+				on delete cascade,
+	constraint messages_pk
+		primary key (id)
+) partition by range (id);
+
+create index messages_channel_id_id_index
+	on messages (channel_id, id);
+
+-- only catches messages if a month was never created
+create table messages_default
+	partition of messages default;
+
+create unlogged table event_bus
+(
+	id bigserial not null
+		constraint event_bus_pk
+			primary key,
+	payload text not null,
+	created_at timestamp with time zone default now() not null
 );
 
-create unique index messages_id_uindex
-	on messages (id);
+-- identify rate limits, kept here so every worker shares them
+create unlogged table session_start_limits
+(
+	user_id bigint not null
+		constraint session_start_limits_pk
+			primary key,
+	remaining integer not null,
+	reset_at timestamp with time zone not null
+);
+
+create unlogged table identify_buckets
+(
+	user_id bigint not null,
+	bucket integer not null,
+	allowed_at timestamp with time zone not null,
+	constraint identify_buckets_pk
+		primary key (user_id, bucket)
+);